@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+admission_enabled = os.getenv("ADMISSION", "1") != "0"
+queue_timeout     = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15"))
+client_header     = os.getenv("RATE_LIMIT_CLIENT_HEADER")
+clients_max       = int(os.getenv("RATE_LIMIT_CLIENTS", "10000"))
+
+metrics.registry.describe('admission_in_flight', 'gauge', 'Requests holding a slot of a limited endpoint')
+metrics.registry.describe('admission_queued', 'gauge', 'Requests waiting for a slot of a limited endpoint')
+metrics.registry.describe('admission_rejected_total', 'counter', 'Requests shed by rate limit, full queue or queue timeout')
+metrics.registry.describe('admission_wait_seconds', 'histogram', 'Time admitted requests waited for a slot')
+
+
+class Rejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBuckets:
+    """Per-client token buckets refilling ``rate`` tokens a second up to ``burst``.
+
+    Beyond ``maxsize`` clients the least recently seen one is forgotten and
+    starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, maxsize=clients_max):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, spend=True):
+        """Take a token for ``key``; returns 0, or the seconds until one is
+        left.  With ``spend`` False only checks that one is left."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0.0
+            if tokens < 1:
+                wait = (1 - tokens) / self.rate
+            elif spend:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class Lane:
+    """Admission to one expensive endpoint.
+
+    Each client may start ``rate`` requests a second, ``burst`` at once,
+    and is answered 429 beyond that; a request that is shed does not count.
+    The buckets are per process, so with several workers a client may
+    start up to that many times as many.  At most ``limit`` requests run at
+    once; up to ``queue`` more wait for a slot, for at most ``timeout``
+    seconds, and the rest are answered 503 straight away.  Retry-After is
+    estimated from how long requests have recently held a slot.  A limit
+    of 0 or a rate of 0 turns that check off.
+
+    Endpoints without a lane are never queued, so as long as the lanes
+    together hold fewer request threads than a worker has, cheap reads
+    always find one.
+    """
+
+    def __init__(self, name, limit, queue, rate, burst, timeout=queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.buckets = TokenBuckets(rate, burst) if rate > 0 else None
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._hold = 1.0
+        self._stats = {'admitted': 0, 'queued': 0, 'rate_limited': 0, 'queue_full': 0, 'queue_timeout': 0}
+        self._labels = {'lane': name}
+
+    def admit(self, client):
+        """Take a slot for ``client`` and return the function that gives it
+        back, or raise Rejected."""
+        self._spend(client, spend=False)
+        if self.limit <= 0:
+            self._spend(client)
+            return self._release_once(time.monotonic(), counted=False)
+
+        start = time.monotonic()
+        with self._cond:
+            if self._active >= self.limit:
+                if self._waiting >= self.queue:
+                    self._reject('queue_full')
+                    raise Rejected(503, 'The service is busy, please try again later.', self._retry_after())
+                self._waiting += 1
+                self._stats['queued'] += 1
+                metrics.registry.set('admission_queued', self._labels, self._waiting)
+                try:
+                    while self._active >= self.limit:
+                        remaining = start + self.timeout - time.monotonic()
+                        if remaining <= 0:
+                            self._reject('queue_timeout')
+                            raise Rejected(503, 'The service is busy, please try again later.', self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                    metrics.registry.set('admission_queued', self._labels, self._waiting)
+            # The token is only spent once the request has its slot, so a
+            # shed request does not count against the client.
+            try:
+                self._spend(client)
+            except Rejected:
+                self._cond.notify()
+                raise
+            self._active += 1
+            self._stats['admitted'] += 1
+            metrics.registry.set('admission_in_flight', self._labels, self._active)
+        now = time.monotonic()
+        metrics.registry.observe('admission_wait_seconds', self._labels, now - start)
+        return self._release_once(now, counted=True)
+
+    def _spend(self, client, spend=True):
+        if self.buckets is None:
+            return
+        wait = self.buckets.take(client, spend)
+        if wait:
+            self._reject('rate_limited')
+            raise Rejected(429, 'Too many requests, please slow down.', wait)
+
+    def _release_once(self, since, counted):
+        done = []
+
+        def release():
+            if done or not counted:
+                return
+            done.append(True)
+            held = time.monotonic() - since
+            with self._cond:
+                self._active -= 1
+                self._hold += (held - self._hold) * 0.2
+                metrics.registry.set('admission_in_flight', self._labels, self._active)
+                self._cond.notify()
+
+        return release
+
+    def _retry_after(self):
+        return self._hold * (self._waiting + 1) / self.limit
+
+    def _reject(self, reason):
+        self._stats[reason] += 1
+        metrics.registry.inc('admission_rejected_total', {'lane': self.name, 'reason': reason})
+
+    def metrics(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(in_flight=self._active, waiting=self._waiting, hold_seconds=round(self._hold, 3))
+        stats.update(limit=self.limit, queue=self.queue, clients=len(self.buckets) if self.buckets else 0)
+        return stats
+
+
+def client_key(request):
+    """Who a request is rate limited as: RATE_LIMIT_CLIENT_HEADER, for
+    example an API key or the first X-Forwarded-For hop behind a proxy,
+    else the peer address."""
+    if client_header:
+        value = request.headers.get(client_header)
+        if value:
+            return value.split(',')[0].strip()
+    return request.remote_addr or ''
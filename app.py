@@ -1,26 +1,298 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
-from google import genai
 import sqlite3
+import db
+import cache
+import profiles
+import prefetch
+import changes
+import network
+import admission
+import writebehind
+import geo
+import search
+import timetable
+import codec
+import compress
 import datetime
-import requests
-from flask import Flask, request, send_file, make_response
+import asyncio
+import queue
+import time
+import threading
+import upstream
+import metrics
+import profiler
+from contextlib import contextmanager
+from flask import Flask, Response, g, has_request_context, request, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse
 import json
+import hashlib
+import urllib.parse
 
 db_file   = "BerlinTravel.db"
-txt_file  = "BerlinTravelGuide.txt"
 
-google_key = os.getenv["GOOGLE_API_KEY"]
+departures_ttl  = float(os.getenv("DEPARTURES_TTL", "30"))
+departures_size = int(os.getenv("DEPARTURES_CACHE_SIZE", "1024"))
+departures_n_max = int(os.getenv("DEPARTURES_N_MAX", "20"))
+
+guide_ttl = float(os.getenv("GUIDE_TTL", str(7 * 24 * 3600)))
+guide_stats = {'hits': 0, 'misses': 0, 'routed': 0, 'refused': 0, 'ttfb_ms': None}
+
+page_limit     = int(os.getenv("PAGE_LIMIT", "100"))
+page_limit_max = int(os.getenv("PAGE_LIMIT_MAX", "1000"))
+
+bulk_max_items   = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+bulk_concurrency = int(os.getenv("BULK_CONCURRENCY", "16"))
+
+changes_poll_interval  = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))
+changes_stream_seconds = float(os.getenv("CHANGES_STREAM_SECONDS", "300"))
+changes_streams        = int(os.getenv("CHANGES_STREAMS", "4"))
+
+batch_max_ids     = int(os.getenv("DEPARTURES_BATCH_MAX", "50"))
+batch_concurrency = int(os.getenv("DEPARTURES_BATCH_CONCURRENCY", "10"))
+
+guide_concurrency    = int(os.getenv("GUIDE_CONCURRENCY", "1"))
+guide_queue          = int(os.getenv("GUIDE_QUEUE", "1"))
+guide_rate           = float(os.getenv("GUIDE_RATE_PER_MINUTE", "6"))
+guide_burst          = int(os.getenv("GUIDE_BURST", "3"))
+profiles_concurrency = int(os.getenv("PROFILES_CONCURRENCY", "2"))
+profiles_queue       = int(os.getenv("PROFILES_QUEUE", "2"))
+profiles_rate        = float(os.getenv("PROFILES_RATE_PER_MINUTE", "60"))
+profiles_burst       = int(os.getenv("PROFILES_BURST", "10"))
+
+swagger_file = os.getenv("SWAGGER_FILE")
+
+google_key = os.getenv("GOOGLE_API_KEY")
 if not google_key:
     raise ValueError("Missing GOOGLE_API_KEY environment variable")
-    
-client = genai.Client(api_key=google_key)
+gemini_base_url = os.getenv("GEMINI_BASE_URL")
+
+pool = db.Pool(db_file, timer=lambda: phase('db'))
+
+# The Gemini SDK takes most of the import time of this module, so it is only
+# imported, and the client only built, when an AI endpoint first needs it.
+client = None
+client_lock = threading.Lock()
+
+def gemini():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                from google import genai
+                options = genai.types.HttpOptions(base_url=gemini_base_url) if gemini_base_url else None
+                client = genai.Client(api_key=google_key, http_options=options)
+    return client
+
+def init_worker():
+    # Called after a server forks a worker (gunicorn post_fork). The pool,
+    # the upstream loop and the prefetcher notice the fork themselves; the
+    # Gemini client's connections must not be shared with the parent.
+    global client
+    client = None
+
+def exit_worker():
+    # Called as a server worker exits (gunicorn worker_exit), so refreshes
+    # still buffered are written before the process goes.
+    writes.flush()
+
+async def fetch_departures(stop_id):
+    return await upstream.vbb_get(f'/stops/{stop_id}/departures', params={'duration': 120})
+
+def departures_payload(r):
+    status = r.status_code
+    if status < 200 or status > 299:
+        return status, None
+    try:
+        return status, timetable.decode(r.content)
+    except ValueError:
+        return 503, None
+
+def load_departures(stop_id):
+    try:
+        with phase('vbb'):
+            r = upstream.run(fetch_departures(stop_id))
+    except upstream.Unavailable:
+        return 503, None
+    status, depas = departures_payload(r)
+    if depas is not None:
+        observe_lines(stop_id, depas)
+    return status, depas
+
+def observe_lines(stop_id, depas):
+    # The line graph only steers /guide, so failing to update it must not
+    # fail the request that fetched the board.
+    try:
+        transit.observe(stop_id, depas)
+    except (sqlite3.Error, db.PoolTimeout):
+        pass
+
+async def load_departures_many(stop_ids):
+    semaphore = asyncio.Semaphore(batch_concurrency)
+
+    async def one(stop_id):
+        async with semaphore:
+            try:
+                return departures_payload(await fetch_departures(stop_id))
+            except upstream.Unavailable:
+                return 503, None
+
+    return await asyncio.gather(*[one(stop_id) for stop_id in stop_ids])
+
+departures = cache.TTLCache(departures_ttl, departures_size, should_cache=lambda res: res[1] is not None)
+
+def get_departures(stop_id):
+    status, depas = departures.get(stop_id, lambda: load_departures(stop_id))
+    # While VBB is failing, the last board we had still lists the departures
+    # to come. It comes with the failed status, so it is never taken for,
+    # nor stored as, a board fetched now.
+    if status >= 500 and depas is None:
+        stale = departures.peek(stop_id, stale=True)
+        if stale is not None:
+            depas = stale[1]
+    return status, depas
+
+def upcoming(depas):
+    now = time.time()
+    return [depa for depa in depas if depa.at is None or depa.at >= now]
+
+def next_departure(depas):
+    for depa in upcoming(depas):
+        if depa.platform is not None and depa.direction is not None:
+            return 'Platform ' + depa.platform + ' towards ' + depa.direction
+    return None
+
+# Its own connection, so a flush never waits behind requests for one.
+writes = writebehind.WriteBehind(db.Pool(db_file, size=1))
+# Lines seen on the boards fetched by reads are written behind with the
+# departures, not by the read.
+transit = network.Network(pool, write=writes.put_lines)
+prefetcher = prefetch.Prefetcher(pool, fetch_departures, timetable.decode, next_departure, observe_lines)
+compactor = changes.Compactor(pool)
+
+# Only the work that waits on Gemini, and the event streams that hold a
+# thread for minutes, is limited; everything else is never queued behind it.
+lanes = {
+    'guide': admission.Lane('guide', guide_concurrency, guide_queue, guide_rate / 60, guide_burst),
+    'profiles': admission.Lane('profiles', profiles_concurrency, profiles_queue, profiles_rate / 60, profiles_burst),
+    'changes': admission.Lane('changes', changes_streams, 0, 0, 1),
+} if admission.admission_enabled else {}
+
+def admit(name):
+    """Take a slot of the named lane for this request, given back once the
+    response is closed; raises admission.Rejected.  Only the expensive part
+    is admitted: answers from storage never wait for a slot."""
+    lane = lanes.get(name)
+    if lane is not None and 'release' not in g:
+        g.release = lane.admit(admission.client_key(request))
+
+def rejected(e):
+    return {'message': e.message}, e.status, {'Retry-After': str(e.retry_after)}
+
+async def generate_profile(op):
+    ai = await asyncio.to_thread(gemini)
+    re = await upstream.generate(ai, f"Give me some information about transport operator {op} in no more than 80 words.")
+    info = re.text
+    if not info or not info.strip():
+        raise ValueError(f"Empty profile generated for {op}")
+    return info.strip()
+
+operator_profiles = profiles.ProfileStore(pool, generate_profile)
+
+def departures_within(depas, minutes):
+    horizon = time.time() + minutes * 60
+    for depa in upcoming(depas):
+        if depa.at is None or depa.at <= horizon:
+            yield depa
 
 app = Flask(__name__)
+
+metrics.registry.describe('http_requests_total', 'counter', 'Requests by endpoint and status code')
+metrics.registry.describe('http_request_duration_seconds', 'histogram', 'Request latency until the body is sent')
+metrics.registry.describe('http_request_phase_seconds', 'histogram', 'Request time spent in db, vbb, gemini, marshal and app code')
+metrics.registry.describe('http_requests_in_flight', 'gauge', 'Requests being served')
+
+@contextmanager
+def phase(name):
+    # Nested phases are subtracted from the enclosing one, so a DB checkout
+    # inside an AI call is counted once, as db.
+    if not has_request_context() or 'phases' not in g:
+        yield
+        return
+    g.phase_stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        inner = g.phase_stack.pop()
+        g.phases[name] = g.phases.get(name, 0.0) + elapsed - inner
+        if g.phase_stack:
+            g.phase_stack[-1] += elapsed
+
+def timed(name, iterator):
+    iterator = iter(iterator)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+@app.before_request
+def start_request():
+    prefetcher.start()
+    compactor.start()
+    g.started = time.perf_counter()
+    g.phases = {}
+    g.phase_stack = []
+    g.sampler = None
+    if profiler.requested(request.headers.get('X-Profile')):
+        g.sampler = profiler.Sampler(threading.get_ident()).start()
+    metrics.registry.add('http_requests_in_flight')
+
+@app.after_request
+def finish_request(response):
+    if 'started' not in g:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    method, status, started, phases, sampler = request.method, response.status_code, g.started, g.phases, g.sampler
+    release = g.pop('release', None)
+    if phases:
+        response.headers.add('Server-Timing', ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in phases.items()))
+    if sampler is not None:
+        path = profiler.path_for(endpoint.strip('/').replace('/', '_').replace('<', '').replace('>', '').replace(':', '-') or 'root')
+        response.headers['X-Profile-File'] = path
+
+    # Runs once the body has been sent, so streamed responses are timed in full.
+    def done():
+        if release is not None:
+            release()
+        seconds = time.perf_counter() - started
+        metrics.registry.add('http_requests_in_flight', value=-1)
+        metrics.registry.inc('http_requests_total', {'method': method, 'endpoint': endpoint, 'status': status})
+        metrics.registry.observe('http_request_duration_seconds', {'method': method, 'endpoint': endpoint}, seconds)
+        for name, spent in phases.items():
+            metrics.registry.observe('http_request_phase_seconds', {'endpoint': endpoint, 'phase': name}, spent)
+        metrics.registry.observe('http_request_phase_seconds', {'endpoint': endpoint, 'phase': 'app'},
+                                 max(seconds - sum(phases.values()), 0.0))
+        if sampler is not None:
+            sampler.stop().write(path)
+
+    response.call_on_close(done)
+    return response
+
+# Registered after finish_request so it runs first and its time is counted.
+@app.after_request
+def compress_response(response):
+    with phase('marshal'):
+        return compress.apply(response, compress.negotiate(request.accept_encodings))
+
 api = Api(
     app,
     version='1.0.1',
@@ -29,6 +301,14 @@ api = Api(
 )
 ns = api.namespace("")
 
+@api.representation('application/json')
+def marshal_json(data, code, headers=None):
+    with phase('marshal'):
+        response = app.make_response((codec.dumps(data) + b'\n', code))
+    response.mimetype = 'application/json'
+    response.headers.extend(headers or {})
+    return response
+
 model_stops = api.model('Stop', {
     'stop_id': fields.Integer(example="8000085"),
     'last_updated': fields.String(example="2025-03-08-12:00:40"),
@@ -55,24 +335,212 @@ model_stops_503 = api.model('StopError503', {
     'message': fields.String(example="Transport Service is not available now.")
 })
 
+model_stops_429 = api.model('StopError429', {
+    'message': fields.String(example="Too many requests, please slow down.")
+})
+
+def include_items():
+    include = request.args.get('include')
+    return include.split(',') if include else []
+
+def project_stop(stop, items):
+    if not items:
+        return stop
+    return {key: value for key, value in stop.items() if key in items or key in ('stop_id', '_links')}
+
+model_stop_list = api.model('StopList', {
+    'stops': fields.List(fields.Nested(api.model('ListedStop', {
+        'stop_id': fields.Integer(example="900100003"),
+        'last_updated': fields.String(example="2025-03-08-12:00:40"),
+        'name': fields.String(example="S+U Alexanderplatz Bhf (Berlin)"),
+        'latitude': fields.Float(example="52.521512"),
+        'longitude': fields.Float(example="13.411267"),
+        'next_departure': fields.String(example="Platform 4 towards S Westkreuz"),
+        '_links': fields.Nested(model_stops['_links'].model),
+    }))),
+    '_links': fields.Nested(api.model('ListLinks', {
+        'self': fields.Nested(model_stops['_links'].model['self'].model),
+        'next': fields.Nested(model_stops['_links'].model['self'].model),
+    })),
+})
+
+model_bulk_patch_item = api.model('BulkPatchItem', {
+    'stop_id': fields.Integer(example="900100003", required=True),
+    'name': fields.String(example="S+U Alexanderplatz"),
+    'next_departure': fields.String(example="Platform 2 towards S+U Pankow"),
+    'latitude': fields.Float(example="52.521512"),
+    'longitude': fields.Float(example="13.411267"),
+    'last_updated': fields.String(example="2025-03-08-12:00:40"),
+})
+
+model_bulk_patch = api.model('BulkPatch', {
+    'results': fields.List(fields.Nested(api.model('BulkPatchResult', {
+        'stop_id': fields.Integer(example="900100003"),
+        'status': fields.Integer(example=200),
+        'last_updated': fields.String(example="2025-03-08-12:00:40"),
+        'message': fields.String(example="This stop is not in the database."),
+    }))),
+    'updated': fields.Integer(example=1),
+    'failed': fields.Integer(example=0),
+    'write_ms': fields.Float(example=1.8),
+})
+
 @ns.route('/stops')
 class ImportStops(Resource):
+    @api.doc(description="List stored stops in stop_id order, one page at a time. Follow _links.next (or the Link "
+                         "header) to get the next page. With q, list the stored stops whose names match it instead, "
+                         "best match first, in one page. Send Accept: application/x-ndjson for one stop per line.")
+    @api.response(200, 'OK', model_stop_list)
+    @api.response(304, 'Not Modified')
+    @api.response(400, 'Bad Request', model_stops_400)
+    @api.param('after', 'Return stops with a stop_id greater than this one, optional')
+    @api.param('q', 'Search stop names: every word starts a word of the name, or is close to one, optional')
+    @api.param('limit', f'Page size, optional, default {page_limit}, at most {page_limit_max}')
+    @api.param('include', 'last_updated / name / latitude / longitude / next_departure, optional')
+    def get(self):
+        try:
+            after = int(request.args.get('after', 0))
+            limit = int(request.args.get('limit', page_limit))
+        except ValueError:
+            return {'message': 'Your request is not valid.'}, 400
+        items = include_items()
+        q = request.args.get('q')
+        if not 0 < limit <= page_limit_max or after > db.INTEGER_MAX or '_links' in items or 'stop_id' in items:
+            return {'message': 'Your request is not valid.'}, 400
+        if q is not None and (not search.words(q) or 'after' in request.args):
+            return {'message': 'Your request is not valid.'}, 400
+
+        with pool.connection() as con:
+            if q is None:
+                rows = con.execute(db.STOP_PAGE, (after, limit + 1)).fetchall()
+            else:
+                found = [sid for sid, _ in search.stops(con, q, limit)]
+                rows = con.execute(db.STOP_ROWS.format(db.placeholders(len(found))), found).fetchall() if found else []
+                rank = {sid: i for i, sid in enumerate(found)}
+                rows.sort(key=lambda row: rank[row[0]])
+        more = len(rows) > limit
+        rows = rows[:limit]
+        # Departures refreshed by reads show before they are written.
+        pending = writes.snapshot()
+        if pending:
+            for i, (sid, _, name, latitude, longitude, _, link) in enumerate(rows):
+                if sid in pending:
+                    depa, dtime = pending[sid]
+                    rows[i] = (sid, dtime, name, latitude, longitude, depa, link)
+
+        ndjson = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+        etag = hashlib.sha1(repr((rows, more, sorted(items), ndjson)).encode()).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        base = "http://127.0.0.1:5000/stops"
+        query = f"&limit={limit}" + (f"&include={','.join(items)}" if items else '')
+        self_link = f"{base}?after={after}{query}" if q is None else f"{base}?q={urllib.parse.quote(q)}{query}"
+        next_link = f"{base}?after={rows[-1][0]}{query}" if more else None
+
+        def encoded():
+            for sid, dtime, name, latitude, longitude, depa, link in rows:
+                stop = {
+                    'stop_id': sid,
+                    'last_updated': dtime,
+                    'name': name,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'next_departure': depa,
+                    '_links': {
+                        'self': {
+                            'href': link or f"{base}/{sid}"
+                        }
+                    }
+                }
+                yield codec.dumps(project_stop(stop, items))
+
+        def stream():
+            if ndjson:
+                for stop in encoded():
+                    yield stop + b'\n'
+                return
+            yield b'{"stops": ['
+            for i, stop in enumerate(encoded()):
+                yield (b', ' if i else b'') + stop
+            links = {'self': {'href': self_link}}
+            if next_link:
+                links['next'] = {'href': next_link}
+            yield b'], "_links": ' + codec.dumps(links) + b'}\n'
+
+        response = Response(stream(), mimetype='application/x-ndjson' if ndjson else 'application/json')
+        response.set_etag(etag)
+        if next_link:
+            response.headers['Link'] = f'<{next_link}>; rel="next"'
+        return response
+
+    @api.doc(description="Update many stops in one transaction. The body is a list of objects, each with a stop_id "
+                         "and the fields to change, as in PATCH /stops/<stop_id>.")
+    @api.response(200, 'OK', model_bulk_patch)
+    @api.response(400, 'Bad Request', model_stops_400)
+    @api.expect([model_bulk_patch_item])
+    def patch(self):
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            body = body.get('stops')
+        if not isinstance(body, list) or not body or len(body) > bulk_max_items:
+            return {'message': f'Your request is not valid, send 1 to {bulk_max_items} stops.'}, 400
+
+        results = []
+        pending = []
+        for item in body:
+            sid = item.get('stop_id') if isinstance(item, dict) else None
+            if not isinstance(sid, int) or isinstance(sid, bool) or not 0 < sid <= db.INTEGER_MAX:
+                results.append({'stop_id': sid, 'status': 400, 'message': 'Input stop_id is not valid.'})
+                continue
+            values, message = stop_update({key: value for key, value in item.items() if key != 'stop_id'})
+            if message:
+                results.append({'stop_id': sid, 'status': 400, 'message': message})
+            else:
+                results.append({'stop_id': sid, 'status': 200, 'last_updated': values[-1]})
+                pending.append((len(results) - 1, values + (sid,)))
+
+        start = time.perf_counter()
+        with pool.transaction() as con:
+            existing = db.existing(con, [row[-1] for _, row in pending])
+            rows = []
+            for i, row in pending:
+                if row[-1] in existing:
+                    rows.append(row)
+                else:
+                    results[i] = {'stop_id': row[-1], 'status': 404, 'message': 'This stop is not in the database.'}
+            con.executemany(db.STOP_PATCH, rows)
+        write_ms = (time.perf_counter() - start) * 1000
+
+        return {'results': results, 'updated': len(rows), 'failed': len(results) - len(rows),
+                'write_ms': round(write_ms, 2)}, 200
+
     @api.response(201, 'Created', model_stops)
     @api.response(200, 'OK', model_stops_200)
     @api.response(400, 'Bad Request', model_stops_400)
     @api.response(404, 'Not Found', model_stops_404)
     @api.response(503, 'Service Unavailable', model_stops_503)  
     @api.param('query', 'Name or keyword of a stop, required')
+    @api.param('source', 'vbb to skip the local name search and always ask VBB, optional')
     def put(self):
-        con = sqlite3.connect(db_file)
-        c = con.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS stops(stop_id INTEGER PRIMARY KEY, name TEXT, \
-                  latitude REAL, longitude REAL, time TEXT, link TEXT, depa TEXT)")
-
         query = request.args.get('query')
+        if query and request.args.get('source') != 'vbb':
+            # Only a query naming a stored stop is answered here; a word that
+            # many names share ('Berlin', 'Bhf') may still find new stops at VBB.
+            with pool.connection() as con:
+                found = [hit for hit in search.stops(con, query, search.CANDIDATES, fuzzy=False) if search.names(query, hit[1])]
+            if found:
+                return {'message': 'This stop is already in the database.'}, 200, {'X-Stop-Search': 'local'}
+
         payload = {'query': query, 'results': '5'}
-        r = requests.get('https://v6.vbb.transport.rest/locations', params=payload)
-        status = r.status_code  
+        try:
+            with phase('vbb'):
+                r = upstream.run(upstream.vbb_get('/locations', params=payload))
+        except upstream.Unavailable:
+            return {'message': 'Transport Service is not available now.'}, 503
+        status = r.status_code
 
         try:
             stops = r.json()
@@ -86,7 +554,7 @@ class ImportStops(Resource):
 
         if not query or status == 400:
             return {'message': 'Your request is not valid.'}, 400
-        elif not r or len(stops) == 0 or 'type' not in stops[0] or status == 404:
+        elif r.is_error or len(stops) == 0 or 'type' not in stops[0] or status == 404:
             return {'message': 'This stop could not be found, try a different keyword.'}, 404
         elif status < 200 or status > 299:
             return {'message': 'Transport Service is not available now.'}, 503
@@ -94,22 +562,20 @@ class ImportStops(Resource):
             output_stops = []
             update_flag = 0
             create_flag = 0
-            for i in range(5):
-                if stops[i]['type'] == 'stop':
-                    stopid = stops[i]['id']
-                    res = c.execute(f"SELECT stop_id FROM stops WHERE stop_id='{stopid}'")
-                    result1 = res.fetchone()
+            with pool.transaction() as con:
+                for i in range(min(5, len(stops))):
+                    if stops[i]['type'] != 'stop':
+                        continue
+                    stopid = int(stops[i]['id'])
+                    result1 = con.execute(db.STOP_EXISTS, (stopid,)).fetchone()
                     if result1 is not None:
-                        time = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-                        c.execute(f"UPDATE stops SET stop_id='{stopid}' WHERE time='{time}'")
                         update_flag = 1
                     else:
                         link = "http://127.0.0.1:5000/stops/" + str(stops[i]['id'])
                         time = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-                        data = (stops[i]['id'], stops[i]['name'], stops[i]['location']['latitude'], \
+                        data = (stopid, stops[i]['name'], stops[i]['location']['latitude'], \
                                 stops[i]['location']['longitude'], time, link)
-                        c.execute("INSERT INTO stops (stop_id, name, latitude, longitude, time, link) VALUES(?, ?, ?, ?, ?, ?)", data)
-                        con.commit()
+                        con.execute(db.STOP_INSERT, data)
                         stop_in = {
                             "stop_id": int(stops[i]['id']),
                             "last_updated": time,
@@ -121,13 +587,156 @@ class ImportStops(Resource):
                         }
                         output_stops.append(stop_in)
                         output_stops.sort(key=lambda x: x['stop_id'])
-                        create_flag = 1 
-            con.close()              
+                        create_flag = 1
             if update_flag == 1:
                 return {'message': 'This stop is already in the database.'}, 200
             elif create_flag == 1:
                 return output_stops, 201
 
+model_bulk_item = api.model('BulkImportItem', {
+    'item': fields.Raw(example="Alexanderplatz"),
+    'status': fields.Integer(example=200),
+    'stop_ids': fields.List(fields.Integer, example=[900100003, 900100703]),
+    'message': fields.String(example="This stop could not be found, try a different keyword."),
+})
+
+model_bulk_summary = api.model('BulkImportSummary', {
+    'summary': fields.Nested(api.model('BulkImportCounts', {
+        'items': fields.Integer(example=2),
+        'failed': fields.Integer(example=0),
+        'stops': fields.Integer(example=6),
+        'created': fields.Integer(example=5),
+        'updated': fields.Integer(example=1),
+        'write_ms': fields.Float(example=3.2),
+    }))
+})
+
+def parse_bulk_items():
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.stream:
+            if line.strip():
+                items.append(json.loads(line))
+        return items
+    items = request.get_json(silent=True)
+    if isinstance(items, dict):
+        items = items.get('items')
+    return items
+
+def bulk_key(item):
+    if isinstance(item, dict):
+        item = item.get('stop_id', item.get('query'))
+    if isinstance(item, str) and item.strip().isdigit():
+        item = int(item)
+    if isinstance(item, int) and not isinstance(item, bool):
+        return item if 0 < item <= db.INTEGER_MAX else None
+    if isinstance(item, str) and item.strip():
+        return item.strip()
+    return None
+
+async def lookup_stops(key, semaphore):
+    async with semaphore:
+        if isinstance(key, int):
+            r = await upstream.vbb_get(f'/stops/{key}')
+        else:
+            r = await upstream.vbb_get('/locations', params={'query': key, 'results': '5'})
+    if r.status_code == 400:
+        return 400, [], 'Your request is not valid.'
+    if r.status_code == 404:
+        return 404, [], 'This stop could not be found, try a different keyword or stop id.'
+    if not r.is_success:
+        return 503, [], 'Transport Service is not available now.'
+    try:
+        found = r.json()
+    except json.JSONDecodeError:
+        return 503, [], 'Transport Service is not available now.'
+    if isinstance(found, dict):
+        found = [found]
+    stops = [stop for stop in found if isinstance(stop, dict) and stop.get('type') == 'stop']
+    if not stops:
+        return 404, [], 'This stop could not be found, try a different keyword or stop id.'
+    return 200, stops, None
+
+async def lookup_all(keys, results):
+    semaphore = asyncio.Semaphore(bulk_concurrency)
+
+    async def one(i, key):
+        try:
+            results.put((i, await lookup_stops(key, semaphore)))
+        except Exception:
+            results.put((i, (503, [], 'Transport Service is not available now.')))
+
+    await asyncio.gather(*[one(i, key) for i, key in enumerate(keys)])
+
+def write_bulk(found):
+    time_now = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+    rows = [(sid, stop['name'], stop['location']['latitude'], stop['location']['longitude'], time_now,
+             "http://127.0.0.1:5000/stops/" + str(sid)) for sid, stop in found.items()]
+    ids = list(found)
+    start = time.perf_counter()
+    with pool.transaction() as con:
+        existing = db.existing(con, ids)
+        con.executemany(db.STOP_UPSERT, rows)
+    write_ms = (time.perf_counter() - start) * 1000
+    return len(rows) - len(existing), len(existing), write_ms
+
+@ns.route('/stops/bulk')
+class BulkImportStops(Resource):
+    @api.doc(description="Import many stops at once. The body is a JSON list (or an application/x-ndjson stream) "
+                         "of stop names, keywords or stop ids. One NDJSON line is streamed back per item as its "
+                         "lookup finishes, followed by a summary line once every stop is written in one transaction.")
+    @api.response(200, 'OK, NDJSON stream of items followed by a summary', model_bulk_item)
+    @api.response(400, 'Bad Request', model_stops_400)
+    def post(self):
+        try:
+            items = parse_bulk_items()
+        except ValueError:
+            return {'message': 'Your request is not valid.'}, 400
+        if not isinstance(items, list) or not items or len(items) > bulk_max_items:
+            return {'message': f'Your request is not valid, send 1 to {bulk_max_items} items.'}, 400
+
+        keys = [bulk_key(item) for item in items]
+        lookups = {}
+        for key in keys:
+            if key is not None and key not in lookups:
+                lookups[key] = len(lookups)
+        unique = list(lookups)
+
+        waiting = {}
+        for item, key in zip(items, keys):
+            if key is not None:
+                waiting.setdefault(lookups[key], []).append(item)
+
+        def generate():
+            results = queue.Queue()
+            if unique:
+                upstream.submit(lookup_all(unique, results))
+            for item, key in zip(items, keys):
+                if key is None:
+                    yield codec.dumps({'item': item, 'status': 400, 'stop_ids': [],
+                                       'message': 'Your request is not valid.'}) + b'\n'
+
+            found = {}
+            failed = sum(1 for key in keys if key is None)
+            for _ in range(len(unique)):
+                with phase('vbb'):
+                    i, (status, stops, message) = results.get()
+                for stop in stops:
+                    found[int(stop['id'])] = stop
+                for item in waiting[i]:
+                    line = {'item': item, 'status': status, 'stop_ids': sorted(int(stop['id']) for stop in stops)}
+                    if message:
+                        line['message'] = message
+                        failed += 1
+                    yield codec.dumps(line) + b'\n'
+
+            created, updated, write_ms = write_bulk(found) if found else (0, 0, 0.0)
+            yield codec.dumps({'summary': {'items': len(items), 'failed': failed, 'stops': len(found),
+                                           'created': created, 'updated': updated,
+                                           'write_ms': round(write_ms, 2)}}) + b'\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 model_thestop = api.model('TheStop', {
     'stop_id': fields.Integer(example="8002549"),
     'last_updated': fields.String(example="2025-03-08-12:00:40"),
@@ -135,6 +744,14 @@ model_thestop = api.model('TheStop', {
     'latitude': fields.Float(example="53.553533"),
     'longitude': fields.Float(example="10.00636"),
     'next_departure': fields.String(example="Platform 4 A-C towards Sollstedt"),
+    'departures': fields.List(fields.Nested(api.model('Departure', {
+        'when': fields.String(example="2025-03-08T12:04:00+01:00"),
+        'platform': fields.String(example="4 A-C"),
+        'direction': fields.String(example="Sollstedt"),
+        'line': fields.String(example="RE1"),
+        'operator': fields.String(example="DB Regio AG Nordost"),
+        'delay': fields.Integer(example=120, description='Seconds, null when there is no realtime data'),
+    })), description='Only with ?n='),
     '_links': fields.Nested(api.model('Links2', {
         'self': fields.Nested(api.model('Self2', {
             'href': fields.String(example="http://127.0.0.1:5000/stops/8002549")
@@ -168,6 +785,44 @@ def non_empty_str(value):
         raise ValueError("Cannot be an empty string")
     return value
 
+def checktime(time_str):
+    try:
+        datetime.datetime.strptime(time_str, '%Y-%m-%d-%H:%M:%S')
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def stop_update(body):
+    if not isinstance(body, dict):
+        return None, 'You did not input anything valid to update.'
+    if '_links' in body or 'stop_id' in body:
+        return None, '_links or stop_id is not allowed in the request.'
+    allowed = ['name', 'next_departure', 'latitude', 'longitude', 'last_updated']
+    if not any(field in body for field in allowed):
+        return None, 'You did not input anything valid to update.'
+
+    values = []
+    for field in ['name', 'next_departure']:
+        value = body.get(field)
+        if value is not None and (not isinstance(value, str) or not value.strip()):
+            return None, f'Your update {field} is invalid.'
+        values.append(value.strip() if value is not None else None)
+
+    for field in ['latitude', 'longitude']:
+        value = body.get(field)
+        if value is not None:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return None, f'Your update {field} is invalid.'
+        values.append(value)
+
+    up_time = body.get('last_updated')
+    if up_time and not checktime(up_time):
+        return None, 'Your update last_updated is invalid.'
+    values.append(up_time or datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S"))
+    return tuple(values), None
+
 post = reqparse.RequestParser()
 post.add_argument('name', type=non_empty_str, required=False, trim=True, nullable=False, help='A non blank string, optional')
 post.add_argument('next_departure', type=non_empty_str, required=False, trim=True, nullable=False, help='A non blank string, optional')
@@ -182,6 +837,8 @@ class TheStop(Resource):
     @api.response(404, 'Not Found', model_stops_404)
     @api.response(503, 'Service Unavailable', model_stops_503)
     @api.param('include', 'last_updated / name / latitude / longitude / next_departure, optional')
+    @api.param('n', f'Also list the next n departures, optional, at most {departures_n_max}')
+    @api.response(304, 'Not Modified')
     def get(self, stop_id):
         the_id = stop_id
         intcheck = isinstance(the_id, int)
@@ -190,121 +847,126 @@ class TheStop(Resource):
                 'message': 'Input stop_id is not valid.'
             }
             return msg, 400  
+        if the_id > db.INTEGER_MAX:
+            return {'message': 'This stop is not in the database.'}, 404
 
         include = request.args.get('include')
         if include:
             items = include.split(',')
         else:
             items = []
+
+        try:
+            n = int(request.args.get('n', 0))
+        except ValueError:
+            n = -1
+        if not 0 <= n <= departures_n_max:
+            return {'message': f'Your request is not valid, n must be 0 to {departures_n_max}.'}, 400
       
-        con = sqlite3.connect(db_file)
-        c = con.cursor()  
-        res = c.execute(f"SELECT stop_id FROM stops WHERE stop_id='{the_id}'") 
-        result = res.fetchone()  
+        # The row is read once: a stop deleted while its departures are
+        # fetched is still answered from this read, not a second one.
+        with pool.connection() as con:
+            result = con.execute(db.STOP_HYDRATE, (the_id,)).fetchone()
 
         if result is None:
             return {'message': 'This stop is not in the database.'}, 404
         elif '_links' in items or 'stop_id' in items:
             return {'message': 'Your request is not valid, _links or stop_id is required.'}, 400
         else:
-            r = requests.get(f'https://v6.vbb.transport.rest/stops/{the_id}/departures?duration=120')
-            status = r.status_code
+            prefetcher.touch(the_id)
+            depa, depa_time, dtime, name, latitude, longitude, self_link, next, prev = result
+            stored_time = dtime
+            pending = writes.get(the_id)
+            if pending is not None:
+                depa, dtime = pending
+                depa_time = dtime
+            # Within the staleness budget the prefetched departure is served
+            # as stored, or as refreshed by a read and not yet written;
+            # otherwise it is fetched and written behind.
+            live = n > 0 or not prefetcher.fresh(depa, depa_time)
+            depas = None
+            if live:
+                status, depas = get_departures(the_id)
+
+                if status == 400:
+                    return {'message': 'Your request is not valid.'}, 400
+                elif 400 < status < 500:
+                    return {'message': 'This stop could not be found, try a different stop id.'}, 404
+                elif status < 300:
+                    depa = next_departure(depas)
+                    dtime = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+                elif depa:
+                    # VBB is unavailable: answer with the departure stored
+                    # last time, as of the time it was stored.
+                    live = False
+                else:
+                    return {'message': 'Transport Service is not available now.'}, 503
 
-            if status == 400:
-                return {'message': 'Your request is not valid.'}, 400
-            elif not r or status == 404:
-                return {'message': 'This stop could not be found, try a different stop id.'}, 404
-            elif status < 200 or status > 299:
-                return {'message': 'Transport Service is not available now.'}, 503
+            if not depa:
+                return {'message': 'This stop has no valid next departure now.'}, 404
             else:
-                depas = r.json()
-                if len(depas['departures']) == 0:
-                    return {'message': 'This stop has no valid next departure now.'}, 404
-
-                depa = ''
-                for i in range(len(depas['departures'])):
-                    if depas['departures'][i]['platform'] is not None and depas['departures'][i]['direction'] is not None:
-                        platform = str(depas['departures'][i]['platform'])
-                        direction = str(depas['departures'][i]['direction'])
-                        depa = 'Platform ' + platform + ' towards ' + direction
-                        dtime = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-                        break
+                # The read takes no write lock; the time shown is the one
+                # the departure was stored or fetched at.
+                if live:
+                    writes.put(the_id, depa, dtime, stored_time)
+                time = dtime
                 
-                if not depa:
-                    return {'message': 'This stop has no valid next departure now.'}, 404
+                if next is not None:
+                    next_link = "http://127.0.0.1:5000/stops/" + str(next)
                 else:
-                    try:
-                        data = (the_id, depa, dtime)
-                        c.execute("INSERT INTO stops (stop_id, depa, time) VALUES(?, ?, ?) ON CONFLICT(stop_id) DO UPDATE SET \
-                                  depa = excluded.depa, time = excluded.time", data)
-                        con.commit()
-
-                        res = c.execute(f"SELECT time, name, latitude, longitude, link FROM stops WHERE stop_id='{the_id}'")
-                        time, name, latitude, longitude, self_link = res.fetchone()
-
-                        re1 = c.execute(f"SELECT stop_id FROM stops WHERE stop_id > '{the_id}' ORDER BY stop_id LIMIT 1")
-                        result1 = re1.fetchone()
-                        if result1 is not None:
-                            next = result1[0]
-                        else:
-                            next = None
-                        
-                        re2 = c.execute(f"SELECT stop_id FROM stops WHERE stop_id < '{the_id}' ORDER BY stop_id DESC LIMIT 1")
-                        result2 = re2.fetchone()
-                        if result2 is not None:
-                            prev = result2[0]
-                        else:
-                            prev = None 
-
-                        con.close()
-                    except sqlite3.Error:
-                        con.close()
-                        return {'message': 'Your request could not be found.'}, 404
-                    
-                    if next is not None:
-                        next_link = "http://127.0.0.1:5000/stops/" + str(next)
-                    else:
-                        next_link = 'This is the last stop, no next stop'
+                    next_link = 'This is the last stop, no next stop'
 
-                    if prev is not None:
-                        prev_link = "http://127.0.0.1:5000/stops/" + str(prev)
-                    else:
-                        prev_link = 'This is the first stop, no prev stop.'
-
-                    stop_info = {
-                        "stop_id": int(the_id),
-                        "last_updated": str(time),
-                        "name": str(name),
-                        "latitude": float(latitude),
-                        "longitude": float(longitude),
-                        "next_departure": depa,
-                        "_links": {
-                            "self": {
-                                "href": self_link
-                            },
-                            "next": {
-                                "href": next_link
-                            },
-                            "prev": {
-                                "href": prev_link
-                            }
-                        } 
-                    }
-                if not items:
-                    return stop_info, 200
+                if prev is not None:
+                    prev_link = "http://127.0.0.1:5000/stops/" + str(prev)
                 else:
-                    include_stop_info = stop_info.copy()
-                    if 'last_updated' not in items:
-                        del include_stop_info['last_updated']
-                    if 'name' not in items:
-                        del include_stop_info['name']
-                    if 'latitude' not in items:
-                        del include_stop_info['latitude']
-                    if 'longitude' not in items:
-                        del include_stop_info['longitude']
-                    if 'next_departure' not in items:
-                        del include_stop_info['next_departure']
-                    return include_stop_info, 200
+                    prev_link = 'This is the first stop, no prev stop.'
+
+                listed = upcoming(depas)[:n] if n and depas else None
+                # Any write to the row changes its time; the rest covers
+                # writes that keep it, the neighbour links and the query.
+                etag = hashlib.sha1(repr((the_id, time, depa, name, latitude, longitude, self_link, next, prev,
+                                          items, n, listed)).encode()).hexdigest()
+                if request.if_none_match.contains_weak(etag):
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return response
+
+                stop_info = {
+                    "stop_id": int(the_id),
+                    "last_updated": str(time),
+                    "name": str(name),
+                    "latitude": float(latitude),
+                    "longitude": float(longitude),
+                    "next_departure": depa,
+                    "_links": {
+                        "self": {
+                            "href": self_link
+                        },
+                        "next": {
+                            "href": next_link
+                        },
+                        "prev": {
+                            "href": prev_link
+                        }
+                    } 
+                }
+                if n:
+                    stop_info['departures'] = [timetable.as_dict(d) for d in listed or ()]
+            if not items:
+                return stop_info, 200, {'ETag': f'"{etag}"'}
+            else:
+                include_stop_info = stop_info.copy()
+                if 'last_updated' not in items:
+                    del include_stop_info['last_updated']
+                if 'name' not in items:
+                    del include_stop_info['name']
+                if 'latitude' not in items:
+                    del include_stop_info['latitude']
+                if 'longitude' not in items:
+                    del include_stop_info['longitude']
+                if 'next_departure' not in items:
+                    del include_stop_info['next_departure']
+                return include_stop_info, 200, {'ETag': f'"{etag}"'}
 
     @api.response(200, 'OK', model_delete)
     @api.response(400, 'Bad Request', model_delete_400)
@@ -318,21 +980,17 @@ class TheStop(Resource):
             }
             return msg, 400
         else:
-            con = sqlite3.connect(db_file)
-            c = con.cursor()  
-            res = c.execute(f"SELECT stop_id FROM stops WHERE stop_id ='{sid}'") 
-            result = res.fetchone() 
-            if result is None:
-                con.close()
+            deleted = 0
+            if sid <= db.INTEGER_MAX:
+                with pool.transaction() as con:
+                    deleted = con.execute(db.STOP_DELETE, (sid,)).rowcount
+            if not deleted:
                 msg = {
                     'message': 'This stop is not in the database.',
                     'stop_id': sid
                 }
                 return msg, 404
             else:
-                res = c.execute(f"DELETE FROM stops WHERE stop_id = '{sid}'")
-                con.commit()
-                con.close()
                 msg = {
                     'message': f'The stop_id {sid} was removed from the database.',
                     'stop_id': sid
@@ -351,135 +1009,30 @@ class TheStop(Resource):
                 'message': 'Input stop_id is not valid.'
             }
             return msg, 400
-        else:
-            con = sqlite3.connect(db_file)
-            c = con.cursor()  
-            res = c.execute(f"SELECT stop_id FROM stops WHERE stop_id ='{sid}'") 
-            result = res.fetchone() 
-            con.close()
-            if result is None:
+        if sid > db.INTEGER_MAX:
+            return {'message': 'This stop is not in the database.', 'stop_id': sid}, 404
+
+        with pool.transaction() as con:
+            if con.execute(db.STOP_EXISTS, (sid,)).fetchone() is None:
                 msg = {
                     'message': 'This stop is not in the database.',
                     'stop_id': sid
                 }
-                return msg, 404            
-
-        data = post.parse_args(req=request)
+                return msg, 404
 
-        unallowed = ['_links', 'stop_id']
-        for field in unallowed:
-            if field in request.json:
+            body = request.get_json(silent=True)
+            if isinstance(body, dict):
+                post.parse_args(req=request)
+            values, message = stop_update(body)
+            if message:
                 msg = {
-                    'message': '_links or stop_id is not allowed in the request.',
+                    'message': message,
                     'stop_id': sid
-                }                 
+                }
                 return msg, 400
 
-        allowed = ['name', 'next_departure', 'latitude', 'longitude', 'last_updated']
-        allow = 0
-        for field in allowed:
-            if field in request.json:
-                allow = 1
-
-        if allow == 0:
-            msg = {
-                'message': 'You did not input anything valid to update.',
-                'stop_id': sid
-            }            
-            return msg, 400            
-
-        up_name = data.get('name')
-        namecheck = isinstance(up_name, str)
-        out_name = None        
-        if up_name.strip() and namecheck:
-            out_name = up_name
-        elif up_name.strip() and not namecheck:
-            msg = {
-                'message': 'Your update name is invalid.',
-                'stop_id': sid
-            }            
-            return msg, 400
-
-        up_depa = data.get('next_departure')
-        depacheck = isinstance(up_depa, str)
-        out_depa = None
-        if up_depa and depacheck:
-            out_depa = up_depa
-        elif up_depa and not depacheck:
-            msg = {
-                'message': 'Your update next_departure is invalid.',
-                'stop_id': sid
-            }            
-            return msg, 400 
-
-        up_la = data.get('latitude')
-        lacheck = isinstance(up_la, float)
-        out_la = None
-        if up_la and lacheck:
-            out_la = up_la
-        elif up_la and not lacheck:
-            msg = {
-                'message': 'Your update latitude is invalid.',
-                'stop_id': sid
-            }            
-            return msg, 400
-
-        up_lo = data.get('longitude')
-        locheck = isinstance(up_lo, float)
-        out_lo = None
-        if up_lo and locheck:
-            out_lo = up_lo
-        elif up_lo and not locheck:
-            msg = {
-                'message': 'Your update longitude is invalid.',
-                'stop_id': sid
-            }            
-            return msg, 400
-
-        def checktime(time_str):
-            try:
-                datetime.datetime.strptime(time_str, '%Y-%m-%d-%H:%M:%S')
-                return True
-            except ValueError:
-                return False     
-
-        up_time = data.get('last_updated')
-        out_time = None
-        if up_time and checktime(up_time):
-            out_time = up_time
-        elif up_time and not checktime(up_time):
-            msg = {
-                'message': 'Your update last_updated is invalid.',
-                'stop_id': sid
-            }            
-            return msg, 400
-        elif not up_time:
-            out_time = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-
-        con = sqlite3.connect(db_file)
-        c = con.cursor()  
-
-        if out_name is not None:
-            c.execute(f"UPDATE stops SET name='{out_name}' WHERE stop_id={sid}")
-            con.commit()        
-
-        if out_depa is not None:
-            c.execute(f"UPDATE stops SET depa='{out_depa}' WHERE stop_id={sid}")
-            con.commit()
-
-        if out_la is not None:
-            c.execute(f"UPDATE stops SET latitude='{out_la}' WHERE stop_id={sid}")
-            con.commit()
-
-        if out_lo is not None:
-            c.execute(f"UPDATE stops SET longitude='{out_lo}' WHERE stop_id={sid}")
-            con.commit()
-
-        if out_time is not None:
-            c.execute(f"UPDATE stops SET time='{out_time}' WHERE stop_id={sid}")
-            con.commit()
-                                    
-        con.close()
+            con.execute(db.STOP_PATCH, values + (sid,))
+        out_time = values[-1]
 
         link = "http://127.0.0.1:5000/stops/" + str(sid)
         fmsg = {
@@ -493,6 +1046,243 @@ class TheStop(Resource):
                 }
         return fmsg, 200
 
+model_nearby = api.model('Nearby', {
+    'latitude': fields.Float(example="52.521512"),
+    'longitude': fields.Float(example="13.411267"),
+    'radius': fields.Float(example="500"),
+    'stops': fields.List(fields.Nested(api.model('NearbyStop', {
+        'stop_id': fields.Integer(example="900100003"),
+        'name': fields.String(example="S+U Alexanderplatz Bhf (Berlin)"),
+        'latitude': fields.Float(example="52.521512"),
+        'longitude': fields.Float(example="13.411267"),
+        'distance': fields.Float(example="0.0"),
+        '_links': fields.Nested(model_stops['_links'].model),
+    })))
+})
+
+near = reqparse.RequestParser()
+near.add_argument('lat', type=float, required=True, location='args', help='Latitude of the centre, required')
+near.add_argument('lon', type=float, required=True, location='args', help='Longitude of the centre, required')
+near.add_argument('radius', type=float, default=500, location='args', help='Search radius in metres, optional, default 500')
+near.add_argument('k', type=int, default=10, location='args', help='Maximum number of stops, optional, default 10')
+
+@ns.route('/stops/nearby')
+class NearbyStops(Resource):
+    @api.response(200, 'OK', model_nearby)
+    @api.response(400, 'Bad Request', model_stops_400)
+    @api.expect(near)
+    def get(self):
+        args = near.parse_args(req=request)
+        lat, lon, radius, k = args['lat'], args['lon'], args['radius'], args['k']
+        if not -90 <= lat <= 90 or not -180 <= lon <= 180 or not 0 < radius <= 50000 or not 0 < k <= 100:
+            return {'message': 'Your request is not valid.'}, 400
+
+        with pool.connection() as con:
+            hits = geo.nearby(con, lat, lon, radius, k)
+
+        stops = []
+        for d, (sid, name, latitude, longitude, link) in hits:
+            stops.append({
+                'stop_id': sid,
+                'name': name,
+                'latitude': latitude,
+                'longitude': longitude,
+                'distance': round(d, 1),
+                '_links': {
+                    'self': {
+                        'href': link
+                    }
+                }
+            })
+        return {'latitude': lat, 'longitude': lon, 'radius': radius, 'stops': stops}, 200
+
+model_departures_batch = api.model('DeparturesBatch', {
+    'stops': fields.List(fields.Nested(api.model('BatchDeparture', {
+        'stop_id': fields.Integer(example="900100003"),
+        'status': fields.Integer(example=200),
+        'next_departure': fields.String(example="Platform 2 towards S+U Pankow"),
+        'last_updated': fields.String(example="2025-03-08-12:00:40"),
+        'message': fields.String(example="This stop is not in the database."),
+        '_links': fields.Nested(model_stops['_links'].model),
+    }))),
+    'fetched': fields.Integer(example=3, description='Stops whose departures were fetched from VBB for this request'),
+})
+
+def batch_departure(stop_id, status, depas, stored):
+    # One stop of GET /stops/departures, mapped like GET /stops/<id>: returns
+    # the JSON entry and whether its departure was fetched just now.
+    depa, _, dtime, link = stored
+    if status == 400:
+        return {'stop_id': stop_id, 'status': 400, 'message': 'Your request is not valid.'}, False
+    if 400 < status < 500:
+        return {'stop_id': stop_id, 'status': 404, 'message': 'This stop could not be found, try a different stop id.'}, False
+    live = status < 300 and depas is not None
+    if live:
+        depa = next_departure(depas)
+        dtime = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+    elif not depa:
+        return {'stop_id': stop_id, 'status': 503, 'message': 'Transport Service is not available now.'}, False
+    if not depa:
+        return {'stop_id': stop_id, 'status': 404, 'message': 'This stop has no valid next departure now.'}, False
+    return {'stop_id': stop_id, 'status': 200, 'next_departure': depa, 'last_updated': dtime,
+            '_links': {'self': {'href': link}}}, live
+
+@ns.route('/stops/departures')
+class StopsDepartures(Resource):
+    @api.doc(description="Next departure of several stored stops at once. Departures that are not fresh in the "
+                         "database or the cache are fetched from VBB concurrently.")
+    @api.response(200, 'OK', model_departures_batch)
+    @api.response(400, 'Bad Request', model_stops_400)
+    @api.param('ids', 'Comma separated stop ids, required')
+    def get(self):
+        try:
+            ids = list(dict.fromkeys(int(i) for i in request.args.get('ids', '').split(',') if i.strip()))
+        except ValueError:
+            ids = []
+        if not ids or len(ids) > batch_max_ids or min(ids) <= 0 or max(ids) > db.INTEGER_MAX:
+            return {'message': f'Your request is not valid, send 1 to {batch_max_ids} stop ids.'}, 400
+
+        with pool.connection() as con:
+            rows = con.execute(db.STOP_DEPA_MANY.format(db.placeholders(len(ids))), ids).fetchall()
+        stored = {sid: (depa, depa_time, dtime, link) for sid, depa, depa_time, dtime, link in rows}
+        stored_times = {sid: entry[2] for sid, entry in stored.items()}
+        for sid in stored:
+            pending = writes.get(sid)
+            if pending is not None:
+                depa, dtime = pending
+                stored[sid] = (depa, dtime, dtime, stored[sid][3])
+
+        answers = {}
+        wanted = []
+        for sid in ids:
+            if sid not in stored:
+                continue
+            prefetcher.touch(sid)
+            if prefetcher.fresh(*stored[sid][:2]):
+                answers[sid] = (200, None)
+            else:
+                wanted.append(sid)
+
+        missing = []
+
+        def load(sids):
+            missing.extend(sids)
+            loaded = upstream.run(load_departures_many(sids))
+            for sid, res in zip(sids, loaded):
+                if res[1] is not None:
+                    observe_lines(sid, res[1])
+            return loaded
+
+        # Stops another request is already fetching are waited for, not
+        # fetched a second time.
+        if wanted:
+            with phase('vbb'):
+                boards = departures.get_many(wanted, load)
+            answers.update(boards)
+
+        results = []
+        for sid in ids:
+            if sid not in stored:
+                results.append({'stop_id': sid, 'status': 404, 'message': 'This stop is not in the database.'})
+                continue
+            status, depas = answers[sid]
+            result, live = batch_departure(sid, status, depas, stored[sid])
+            results.append(result)
+            if live:
+                writes.put(sid, result['next_departure'], result['last_updated'], stored_times[sid])
+
+        return {'stops': results, 'fetched': len(missing)}, 200
+
+model_changes = api.model('StopChanges', {
+    'changes': fields.List(fields.Nested(api.model('StopChange', {
+        'seq': fields.Integer(example=1042),
+        'stop_id': fields.Integer(example="900100003"),
+        'op': fields.String(example="update", description='insert / update / delete, the latest change of the stop'),
+        'changed': fields.String(example="2025-03-08 11:00:40", description='UTC'),
+        'stop': fields.Nested(model_stop_list['stops'].container.model, allow_null=True,
+                              description='The stop as it is now, null once deleted'),
+    }))),
+    'last_seq': fields.Integer(example=1042, description='Send as since to get the changes after these'),
+    'more': fields.Boolean(example=False),
+})
+
+model_changes_410 = api.model('StopChanges410', {
+    'message': fields.String(example="Changes before seq 977 were compacted, sync again from since=0."),
+})
+
+def stop_change(seq, stop_id, op, changed, row):
+    stop = None
+    if row is not None:
+        sid, time, name, latitude, longitude, depa, link = row
+        stop = {'stop_id': sid, 'last_updated': time, 'name': name, 'latitude': latitude, 'longitude': longitude,
+                'next_departure': depa, '_links': {'self': {'href': link or f"http://127.0.0.1:5000/stops/{sid}"}}}
+    return {'seq': seq, 'stop_id': stop_id, 'op': op, 'changed': changed, 'stop': stop}
+
+@ns.route('/stops/changes')
+class StopChanges(Resource):
+    @api.doc(description="Changes of the stored stops after the sequence number since, for mirrors of the stops "
+                         "table. Each changed stop is listed once, with its latest change and current data. Start "
+                         "from since=0, which lists every stop, then pass the returned last_seq. Send Accept: "
+                         "text/event-stream to follow the changes as Server-Sent Events; Last-Event-ID resumes.")
+    @api.response(200, 'OK', model_changes)
+    @api.response(400, 'Bad Request', model_stops_400)
+    @api.response(410, 'Gone', model_changes_410)
+    @api.response(503, 'Service Unavailable', model_stops_503)
+    @api.param('since', 'Sequence number of the last change seen, optional, default 0')
+    @api.param('limit', f'Changes per page, optional, default {page_limit}, at most {page_limit_max}')
+    def get(self):
+        try:
+            since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+            limit = int(request.args.get('limit', page_limit))
+        except ValueError:
+            return {'message': 'Your request is not valid.'}, 400
+        if not 0 <= since <= db.INTEGER_MAX or not 0 < limit <= page_limit_max:
+            return {'message': 'Your request is not valid.'}, 400
+
+        try:
+            with pool.connection() as con:
+                rows = changes.since(con, since, limit)
+        except changes.Gone as e:
+            return {'message': f'Changes before seq {e.horizon} were compacted, sync again from since=0.'}, 410
+
+        if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) != 'text/event-stream':
+            return {'changes': [stop_change(*row) for row in rows],
+                    'last_seq': rows[-1][0] if rows else since, 'more': len(rows) == limit}, 200
+        try:
+            admit('changes')
+        except admission.Rejected as e:
+            return rejected(e)
+
+        def stream(rows, since):
+            # Polls the log, so changes written by other workers are seen too.
+            # The stream ends after a while and the client reconnects with
+            # Last-Event-ID, which keeps request threads from being held forever.
+            deadline = time.monotonic() + changes_stream_seconds
+            idle = 0.0
+            yield f'retry: {int(changes_poll_interval * 1000)}\n\n'
+            while True:
+                for row in rows:
+                    since = row[0]
+                    yield f'id: {since}\nevent: {row[2]}\ndata: {codec.dumps(stop_change(*row)).decode()}\n\n'
+                if len(rows) < limit:
+                    if time.monotonic() >= deadline:
+                        return
+                    time.sleep(changes_poll_interval)
+                    idle = 0.0 if rows else idle + changes_poll_interval
+                    if idle >= 15:
+                        idle = 0.0
+                        yield ': keep-alive\n\n'
+                try:
+                    with pool.connection() as con:
+                        rows = changes.since(con, since, limit)
+                except changes.Gone:
+                    return
+
+        response = Response(stream_with_context(stream(rows, since)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
 model_pro = api.model('Profile', {
     'operator_name': fields.String(example="DB Fernverkehr AG"),
     'information': fields.String(example="DB Fernverkehr AG is a subsidiary of Deutsche Bahn that operates long-distance passenger trains in Germany.")
@@ -508,38 +1298,34 @@ class Operators(Resource):
     @api.response(200, 'OK', model_op)
     @api.response(400, 'Bad Request', model_stops_400)
     @api.response(404, 'Not Found', model_stops_404)
+    @api.response(429, 'Too Many Requests', model_stops_429)
     @api.response(503, 'Service Unavailable', model_stops_503)    
     def get(self, stop_id):
         sid = stop_id
-        con = sqlite3.connect(db_file)
-        c = con.cursor()  
-        res = c.execute("SELECT stop_id FROM stops WHERE stop_id='{si}'".format(si=sid)) 
-        result = res.fetchone()  
-        con.close()
+        result = None
+        if sid <= db.INTEGER_MAX:
+            with pool.connection() as con:
+                result = con.execute(db.STOP_EXISTS, (sid,)).fetchone()
 
         if result is None:
             return {'message': 'This stop is not in the database.'}, 404        
         else:
-            r = requests.get(f'https://v6.vbb.transport.rest/stops/{sid}/departures?duration=90')
-            status = r.status_code
+            status, depas = get_departures(sid)
 
             if status == 400:
                 return {'message': 'Your request is not valid.'}, 400
-            elif not r or status == 404:
+            elif 400 < status < 500:
                 return {'message': 'This stop could not be found, try a different stop id.'}, 404
-            elif status < 200 or status > 299:
+            elif depas is None:
                 return {'message': 'Transport Service is not available now.'}, 503
             else:
-                depas = r.json()
-                if len(depas['departures']) == 0:
+                upcoming = list(departures_within(depas, 90))
+                if len(upcoming) == 0:
                     return {'message': 'This stop has no valid next departure now.'}, 404
 
                 ops = []
-                for i in range(len(depas['departures'])):
-                    try:
-                        op = depas['departures'][i]['line']['operator']['name']
-                    except KeyError:
-                        continue
+                for depa in upcoming:
+                    op = depa.operator
                     if op is not None and op not in ops:
                         ops.append(op)
                     if len(ops) > 4:
@@ -548,26 +1334,27 @@ class Operators(Resource):
                 if not ops:
                     return {'message': 'This stop has no valid departure operator now.'}, 404
                 else:
-                    profs = []
-                    for op in ops:
-                        try:
-                            re = client.models.generate_content(
-                                model="gemini-2.0-flash",
-                                contents=f"Give me some information about transport operator {op} in no more than 80 words.",
-                            )
-                        except Exception:
-                            return {'message': 'AI Service is not available now.'}, 503
-
-                        info = re.text
-                        if not info.strip():
-                            return {'message': 'AI Service is not available now.'}, 503
-
-                        prof = {'operator_name': op, 'information': info.strip()}
-                        profs.append(prof)
-
+                    try:
+                        with phase('gemini'):
+                            infos = operator_profiles.get_many(ops, admit=lambda: admit('profiles'))
+                    except admission.Rejected as e:
+                        return rejected(e)
+                    except Exception:
+                        return {'message': 'AI Service is not available now.'}, 503
+
+                    profs = [{'operator_name': op, 'information': infos[op]} for op in ops]
                     response = {'stop_id': sid, 'profiles': profs}
                     return response, 200
 
+def guide_response(body, cache_status, ttfb=None):
+    response = Response(body, mimetype='text/plain')
+    response.headers['Content-Disposition'] = 'attachment; filename=Guide.txt'
+    response.headers['X-Guide-Cache'] = cache_status
+    if ttfb is not None:
+        response.headers['X-Time-To-First-Byte'] = f'{ttfb:.1f}ms'
+        response.headers['Server-Timing'] = f'ai-ttfb;dur={ttfb:.1f}'
+    return response
+
 model_guide = api.model('Guide', {
     'Web Browser': fields.String(example="We recommend using a web browser for this guide, a Guide.txt file will automatically download for you."),
     'curl': fields.String(example="If you run curl from a terminal, the guide text will be printed on your screen."),
@@ -577,37 +1364,126 @@ model_guide = api.model('Guide', {
 class Guide(Resource):
     @api.response(200, 'OK', model_guide)
     @api.response(400, 'Bad Request', model_stops_400)
-    @api.response(503, 'Service Unavailable', model_stops_503)    
+    @api.response(429, 'Too Many Requests', model_stops_429)
+    @api.response(503, 'Service Unavailable', model_stops_503)
     def get(self):
-        con = sqlite3.connect(db_file)
-        c = con.cursor()
-        c.execute("SELECT name FROM stops")
-        results = c.fetchall()
-        stops = '; '.join([row[0] for row in results])
-        c.close()
-        con.close()  
+        with pool.connection() as con:
+            results = con.execute(db.STOP_NAMES).fetchall()
+        names = sorted(set(row[0] for row in results if row[0]))
+        stops = '; '.join(names)
 
         if len(results) < 2:
             return {'message': 'You have not put enough stops for a guide.'}, 400
 
+        digest = hashlib.sha256('\n'.join(names).encode()).hexdigest()
+
+        def lookup():
+            with pool.connection() as con:
+                return con.execute(db.GUIDE_SELECT, (digest, time.time() - guide_ttl)).fetchone()
+
+        cached = lookup()
+        if cached is None:
+            try:
+                admit('guide')
+            except admission.Rejected as e:
+                return rejected(e)
+            # A request queued behind the one generating this guide finds it stored.
+            cached = lookup()
+        if cached is not None:
+            guide_stats['hits'] += 1
+            return guide_response(cached[0], 'HIT')
+        guide_stats['misses'] += 1
+
+        start = time.perf_counter()
         try:
-            re = client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=f"Here are some European stops: {stops}. Choose any 2 of them, one as start and the other as destination, use Google map to check if there is a public transport line between them, choose 1 and give a detailed introduction, include all information that would be useful for a tourist, like time, price, service, food&drinks, air conditioner, pets, toliets, smoking, wifi; you must include at least 1 point of interests for both start and destination, introduce each point in 200 words including address, opening time, ticket price, food&drinks, recommendation, anecdote. If there is no public transport line between any 2 stops I provide or there is any other problem that you cannot complete this task, just answer me NOTFOUND.",
-            )
+            ai = gemini()
         except Exception:
             return {'message': 'AI Service is not available now.'}, 503
+        # A pair of stored stops on the same line, known from the departure
+        # boards, makes a short prompt that rarely ends in NOTFOUND; asking
+        # the model to find a pair among all stops is the fallback.
+        with pool.connection() as con:
+            route = transit.pair(con)
+        if route is not None:
+            guide_stats['routed'] += 1
+            _, origin, _, destination, line, direction = route
+            prompt = f"Give a detailed introduction to the trip from {origin} to {destination} in Berlin on public transport line {line} (towards {direction}), include all information that would be useful for a tourist, like time, price, service, food&drinks, air conditioner, pets, toliets, smoking, wifi; you must include at least 1 point of interests for both start and destination, introduce each point in 200 words including address, opening time, ticket price, food&drinks, recommendation, anecdote. If there is any problem that you cannot complete this task, just answer me NOTFOUND."
+        else:
+            prompt = f"Here are some European stops: {stops}. Choose any 2 of them, one as start and the other as destination, use Google map to check if there is a public transport line between them, choose 1 and give a detailed introduction, include all information that would be useful for a tourist, like time, price, service, food&drinks, air conditioner, pets, toliets, smoking, wifi; you must include at least 1 point of interests for both start and destination, introduce each point in 200 words including address, opening time, ticket price, food&drinks, recommendation, anecdote. If there is no public transport line between any 2 stops I provide or there is any other problem that you cannot complete this task, just answer me NOTFOUND."
+        parts = upstream.iterate(upstream.generate_stream(ai, prompt))
+        chunks = (part.text for part in timed('gemini', parts) if part.text)
+
+        # Hold back the start of the answer until it cannot be a bare NOTFOUND.
+        head = ''
+        try:
+            for chunk in chunks:
+                head += chunk
+                if len(head.strip()) > len('NOTFOUND'):
+                    break
+        except Exception:
+            parts.close()
+            return {'message': 'AI Service is not available now.'}, 503
+        ttfb = (time.perf_counter() - start) * 1000
+        guide_stats['ttfb_ms'] = round(ttfb, 1)
 
-        guide = re.text
-        if 'NOTFOUND' in guide or not guide:
+        if 'NOTFOUND' in head or not head.strip():
+            parts.close()
             return {'message': 'Oops, we cannot provide a guide for your stops.'}, 400
 
-        with open(txt_file, 'w') as f:
-            f.write(guide)
+        def stream():
+            guide = [head]
+            yield head
+            try:
+                for chunk in chunks:
+                    guide.append(chunk)
+                    yield chunk
+            finally:
+                parts.close()
+            # Only a guide streamed to its end is kept, and not one where
+            # the model gave up after the part held back.
+            text = ''.join(guide)
+            if 'NOTFOUND' in text:
+                guide_stats['refused'] += 1
+                return
+            with pool.transaction() as con:
+                con.execute(db.GUIDE_UPSERT, (digest, text, time.time()))
+
+        return guide_response(stream_with_context(stream()), 'MISS', ttfb)
+
+def stats():
+    return {'db_pool': pool.metrics(), 'departures_cache': departures.metrics(),
+            'operator_profiles': operator_profiles.metrics(), 'guides': dict(guide_stats),
+            'prefetcher': prefetcher.metrics(), 'vbb_breaker': upstream.breaker.metrics(),
+            'stop_changes': compactor.metrics(), 'network': transit.metrics(),
+            'admission': {lane.name: lane.metrics() for lane in lanes.values()},
+            'write_behind': writes.metrics()}
+
+@ns.route('/stats', doc=False)
+class Stats(Resource):
+    def get(self):
+        return {'pid': os.getpid(), **stats()}, 200
 
-        response = make_response(send_file(txt_file, as_attachment=True, download_name='Guide.txt'))
-        response.status_code = 200
-        return response
+@ns.route('/metrics', doc=False)
+class Metrics(Resource):
+    def get(self):
+        extra = [(f'{group}_{key}', None, value) for group, values in stats().items()
+                 for key, value in values.items() if isinstance(value, (int, float))]
+        return Response(metrics.registry.render(extra), mimetype='text/plain; version=0.0.4')
+
+def write_swagger(path):
+    with app.test_request_context():
+        spec = api.__schema__
+    with open(path, 'w') as f:
+        json.dump(spec, f, indent=4)
+
+# A spec written by write_swagger at build time is served as it is instead
+# of being generated from the models on the first /swagger.json request.
+if swagger_file and os.path.exists(swagger_file):
+    with open(swagger_file) as f:
+        api._schema = json.load(f)
 
 if __name__ == '__main__':
-    app.run(debug=False)
+    if sys.argv[1:2] == ['--write-swagger']:
+        write_swagger(sys.argv[2] if len(sys.argv) > 2 else 'docs/swagger.json')
+    else:
+        app.run(debug=False, port=int(os.getenv("PORT", "5000")))
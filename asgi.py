@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+# ASGI entry point: uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# The flask-restx resources stay synchronous and run on a bounded thread
+# pool, while every VBB and Gemini call they make is awaited on the
+# server's own event loop (see upstream.attach).  A request thread therefore
+# only parks on a future instead of owning a socket, and the pooled HTTP/2
+# client multiplexes all of them over a handful of keep-alive connections.
+
+import asyncio
+import os
+from a2wsgi import WSGIMiddleware
+import upstream
+from app import app
+
+asgi_threads = int(os.getenv("ASGI_THREADS", "64"))
+
+wsgi = WSGIMiddleware(app, workers=asgi_threads)
+
+
+async def application(scope, receive, send):
+    upstream.attach(asyncio.get_running_loop())
+    await wsgi(scope, receive, send)
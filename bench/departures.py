@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Parse time and memory of a VBB departures board: json.loads keeping the
+# whole payload, as the API used to cache it, against timetable.decode.
+# Each payload is timed parsing plus picking the next departure; memory is
+# the tracemalloc peak of one parse and what --boards cached boards retain.
+#
+# Boards are recorded responses given with --payload, e.g.
+#
+#   curl -o hbf.json 'https://v6.vbb.transport.rest/stops/900003201/departures?duration=120'
+#   python bench/departures.py --payload hbf.json
+#
+# or, without any, stand-in boards of --count departures.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import timetable
+import vbb_standin
+
+
+def raw(content):
+    depas = json.loads(content)
+    for depa in depas['departures']:
+        if depa['platform'] is not None and depa['direction'] is not None:
+            return depas, 'Platform ' + str(depa['platform']) + ' towards ' + str(depa['direction'])
+    return depas, None
+
+
+def compact(content):
+    depas = timetable.decode(content)
+    for depa in depas:
+        if depa.platform is not None and depa.direction is not None:
+            return depas, 'Platform ' + depa.platform + ' towards ' + depa.direction
+    return depas, None
+
+
+def parse_ms(parse, payloads, repeat):
+    for content in payloads:
+        parse(content)
+    samples = []
+    for _ in range(repeat):
+        for content in payloads:
+            start = time.perf_counter()
+            parse(content)
+            samples.append(time.perf_counter() - start)
+    return {'p50_ms': round(statistics.median(samples) * 1000, 3),
+            'p99_ms': round(statistics.quantiles(samples, n=100)[98] * 1000, 3) if len(samples) > 1 else None}
+
+
+def memory_kb(parse, payloads, boards):
+    tracemalloc.start()
+    parse(payloads[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    kept = [parse(payloads[i % len(payloads)])[0] for i in range(boards)]
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return {'parse_peak_kb': round(peak / 1024, 1), 'retained_kb_per_board': round(retained / boards / 1024, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Departures board parse time and memory')
+    parser.add_argument('--payload', action='append', help='recorded departures response, repeatable')
+    parser.add_argument('--count', type=int, default=600, help='departures per stand-in board')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--boards', type=int, default=100, help='boards kept for the retained size')
+    args = parser.parse_args()
+
+    if args.payload:
+        payloads = [open(path, 'rb').read() for path in args.payload]
+    else:
+        payloads = [json.dumps(vbb_standin.departures(900000000 + i, 120, args.count)).encode()
+                    for i in range(5)]
+
+    result = {'payload_kb': round(statistics.fmean(len(p) for p in payloads) / 1024, 1),
+              'departures': len(timetable.decode(payloads[0]))}
+    for name, parse in (('raw', raw), ('compact', compact)):
+        result[name] = dict(parse_ms(parse, payloads, args.repeat), **memory_kb(parse, payloads, args.boards))
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
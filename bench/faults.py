@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Drives the API against a fault-injecting VBB stand-in and checks that it
+# degrades instead of stalling:
+#
+#   tail    5% of VBB replies take a second; hedged GETs should cut the p99
+#   outage  VBB answers 503 to everything; stops that were read before are
+#           still served from their stored departure and the breaker opens
+#   hang    VBB stops answering; calls end at the timeout, then fail fast
+#
+#   python bench/faults.py
+#
+# Exits non-zero if a scenario does not behave as described.
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import httpx
+
+import vbb_standin
+from load import percentile, start
+
+
+async def hit(base, ids, rounds, concurrency):
+    latencies, statuses = [], {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(client, sid):
+        async with semaphore:
+            start = time.perf_counter()
+            r = await client.get(f'/stops/{sid}')
+            latencies.append(time.perf_counter() - start)
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+    async with httpx.AsyncClient(base_url=base, timeout=60,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        await asyncio.gather(*[one(client, sid) for _ in range(rounds) for sid in ids])
+    return {
+        'requests': len(latencies),
+        'statuses': statuses,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'max_ms': round(max(latencies) * 1000, 1),
+    }
+
+
+def run(server, env, setup=None):
+    server.faults.update(error_rate=0, slow_rate=0)
+    proc, base = start('sync', f'http://127.0.0.1:{server.server_port}',
+                       dict(env, DEPARTURES_MAX_AGE='0'))
+    try:
+        ids = [stop['stop_id'] for stop in httpx.put(base + '/stops', params={'query': 'faults'}).json()]
+        asyncio.run(hit(base, ids, 1, 5))
+        if setup:
+            setup()
+        result = asyncio.run(hit(base, ids, args.rounds, args.concurrency))
+        result['breaker'] = httpx.get(base + '/stats').json()['vbb_breaker']
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def faults(**values):
+    return lambda: server.faults.update(values)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='API behaviour under VBB faults')
+    parser.add_argument('--rounds', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=20, help='milliseconds VBB normally takes')
+    args = parser.parse_args()
+    server = vbb_standin.serve(latency=args.latency / 1000)
+
+    slow = faults(slow_rate=0.05, slow=1.0)
+    results = {
+        'tail': run(server, {}, slow),
+        'tail_hedged': run(server, {'UPSTREAM_HEDGE_MS': str(4 * args.latency)}, slow),
+        'outage': run(server, {}, faults(error_rate=1.0)),
+        'hang': run(server, {'UPSTREAM_TIMEOUT': '1'}, faults(slow_rate=1.0, slow=30)),
+    }
+    checks = {
+        'hedging_cuts_p99': results['tail_hedged']['p99_ms'] < results['tail']['p99_ms'] / 2,
+        'outage_serves_stored': set(results['outage']['statuses']) == {200},
+        'outage_opens_breaker': results['outage']['breaker']['opened'] > 0,
+        'hang_fails_fast': results['hang']['p50_ms'] < 100 and results['hang']['max_ms'] < 2000,
+    }
+    print(json.dumps({'results': results, 'checks': checks}, indent=2))
+    sys.exit(0 if all(checks.values()) else 1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the Gemini API, answering generateContent and
+# streamGenerateContent with canned text: after --latency, and streamed in
+# --chunks pieces --chunk-latency apart. The canned answers can be replaced
+# with a JSON file of [prompt substring, answer] pairs; the first pair whose
+# substring is in the prompt is used.
+#
+#   python bench/gemini_standin.py --port 3001 --latency 300 --chunk-latency 30
+#   GEMINI_BASE_URL=http://127.0.0.1:3001 python app.py
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROFILE = ('Berliner Verkehrsbetriebe (BVG) runs the U-Bahn, trams and most buses in Berlin. It carries about '
+           'a billion passengers a year on ten U-Bahn lines, 22 tram lines and over 150 bus routes, many of them '
+           'around the clock at weekends. Tickets are shared across the VBB fare zones A, B and C.')
+GUIDE = ' '.join(['From S+U Alexanderplatz take the U2 towards Ruhleben and ride six stops to Potsdamer Platz.',
+                  'Trains run every five minutes, a single AB ticket costs 3.80 EUR and is valid for two hours.',
+                  'The cars have no air conditioning but are rarely crowded outside the rush hour; dogs travel',
+                  'with a reduced ticket, smoking is not allowed and there are no toilets or wifi on board.']
+                 * 12)
+CANNED = [['transport operator', PROFILE], ['public transport line', GUIDE], ['', 'OK']]
+
+
+def candidate(text, last):
+    body = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0}],
+            'modelVersion': 'gemini-2.0-flash'}
+    if last:
+        body['candidates'][0]['finishReason'] = 'STOP'
+        body['usageMetadata'] = {'promptTokenCount': 100, 'candidatesTokenCount': len(text) // 4,
+                                 'totalTokenCount': 100 + len(text) // 4}
+    return body
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+    chunk_latency = 0.0
+    chunks = 10
+    canned = CANNED
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt = ' '.join(part.get('text', '') for content in request.get('contents', [])
+                          for part in content.get('parts', []))
+        answer = next(text for key, text in self.canned if key in prompt)
+        time.sleep(self.latency)
+        self.server.calls += 1
+        if self.path.split('?')[0].endswith(':streamGenerateContent'):
+            self.stream(answer)
+        elif self.path.split('?')[0].endswith(':generateContent'):
+            self.reply(200, candidate(answer, True))
+        else:
+            self.reply(404, {'error': {'code': 404, 'message': 'not found', 'status': 'NOT_FOUND'}})
+
+    def stream(self, answer):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        size = max(1, -(-len(answer) // self.chunks))
+        pieces = [answer[i:i + size] for i in range(0, len(answer), size)]
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(self.chunk_latency)
+            event = f'data: {json.dumps(candidate(piece, i == len(pieces) - 1))}\r\n\r\n'.encode()
+            self.wfile.write(f'{len(event):x}\r\n'.encode() + event + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve(port=0, latency=0.0, chunk_latency=0.0, chunks=10, canned=None):
+    """Start the stand-in in a daemon thread and return the server."""
+    handler = type('StandinHandler', (Handler,), {'latency': latency, 'chunk_latency': chunk_latency,
+                                                  'chunks': chunks, 'canned': canned or CANNED})
+    server = Server(('127.0.0.1', port), handler)
+    server.calls = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Gemini API stand-in')
+    parser.add_argument('--port', type=int, default=3001)
+    parser.add_argument('--latency', type=float, default=300, help='milliseconds before the first chunk')
+    parser.add_argument('--chunk-latency', type=float, default=30, help='milliseconds between streamed chunks')
+    parser.add_argument('--chunks', type=int, default=10, help='chunks a streamed answer is split into')
+    parser.add_argument('--responses', help='JSON file of [prompt substring, answer] pairs')
+    args = parser.parse_args()
+    canned = json.load(open(args.responses)) + CANNED if args.responses else None
+    server = serve(args.port, args.latency / 1000, args.chunk_latency / 1000, args.chunks, canned)
+    print(f'Gemini stand-in on http://127.0.0.1:{server.server_port} (+{args.latency:.0f} ms)')
+    threading.Event().wait()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Cost of the line graph behind /guide: recording the lines of a departures
+# board with Network.observe, the first time and again within the refresh
+# hour, and picking a pair of stops sharing a line, for --stops stand-in
+# stops. Also prints how many characters of stops the /guide prompt carries
+# listing every stop, against naming one pair and its line.
+#
+#   python bench/linegraph.py --stops 2000 --repeat 200
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+import network
+import timetable
+import vbb_standin
+
+
+def us(samples):
+    return round(statistics.median(samples) * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Line graph write and query cost')
+    parser.add_argument('--stops', type=int, default=2000)
+    parser.add_argument('--departures', type=int, default=60, help='departures per board')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    pool = db.Pool(os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    ids = [900000000 + i for i in range(args.stops)]
+    with pool.transaction() as con:
+        con.executemany(db.STOP_INSERT, [(sid, f'Stop {sid}', 52.5, 13.4, '', '') for sid in ids])
+    boards = {sid: timetable.decode(json.dumps(vbb_standin.departures(sid, 120, args.departures)))
+              for sid in ids}
+    transit = network.Network(pool)
+
+    written = []
+    for sid in ids:
+        start = time.perf_counter()
+        transit.observe(sid, boards[sid])
+        written.append(time.perf_counter() - start)
+    skipped = []
+    for sid in ids[:args.repeat]:
+        start = time.perf_counter()
+        transit.observe(sid, boards[sid])
+        skipped.append(time.perf_counter() - start)
+    picked = []
+    with pool.connection() as con:
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            route = transit.pair(con)
+            picked.append(time.perf_counter() - start)
+        rows = con.execute('SELECT COUNT(*) FROM stop_lines').fetchone()[0]
+        names = '; '.join(sorted(row[0] for row in con.execute(db.STOP_NAMES)))
+
+    print(json.dumps({
+        'stops': args.stops,
+        'stop_lines': rows,
+        'observe_write_us': us(written),
+        'observe_skip_us': us(skipped),
+        'pair_us': us(picked),
+        'prompt_stop_chars': {'all stops': len(names), 'pair': len(' '.join(map(str, route)))},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
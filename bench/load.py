@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Throughput of GET /stops/<id> under the sync dev server, the ASGI server
+# and gunicorn (threaded or with uvicorn workers), all talking to the local
+# VBB stand-in (bench/vbb_standin.py) running in its own process.
+#
+#   python bench/load.py --mode both --concurrency 64 --duration 10 --latency 100
+#   python bench/load.py --mode all
+#
+# The departures cache and the prefetcher are disabled (DEPARTURES_TTL=0,
+# PREFETCH=0) so every request pays the upstream round trip, which is what
+# the serving mode changes.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'sync':  [sys.executable, os.path.join(root, 'app.py')],
+    'async': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+              '--port', '{port}', '--log-level', 'warning'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '-c', os.path.join(root, 'gunicorn.conf.py'),
+                 '--bind', '127.0.0.1:{port}', 'app:app'],
+    'gunicorn-async': [sys.executable, '-m', 'gunicorn', '-c', os.path.join(root, 'gunicorn.conf.py'),
+                       '--bind', '127.0.0.1:{port}', '-k', 'uvicorn_worker.UvicornWorker', 'asgi:application'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_standin(latency):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, os.path.join(root, 'bench', 'vbb_standin.py'),
+                             '--port', str(port), '--latency', str(latency)],
+                            stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return proc, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('VBB stand-in did not start')
+
+
+def start(mode, vbb, extra_env=None):
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), VBB_BASE_URL=vbb, GOOGLE_API_KEY='bench',
+               DEPARTURES_TTL='0', PREFETCH='0', PYTHONPATH=root)
+    env.update(extra_env or {})
+    cmd = [arg.format(port=port) for arg in COMMANDS[mode]]
+    proc = subprocess.Popen(cmd, cwd=tempfile.mkdtemp(), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            httpx.get(base + '/swagger.json', timeout=1)
+            return proc, base
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f'{mode} server did not start')
+
+
+def seed(base, queries):
+    ids = []
+    for query in queries:
+        r = httpx.put(base + '/stops', params={'query': query}, timeout=30)
+        if r.status_code == 201:
+            ids.extend(stop['stop_id'] for stop in r.json())
+    return ids
+
+
+async def drive(base, ids, concurrency, duration):
+    latencies = []
+    errors = 0
+
+    # One keep-alive connection per simulated user: a single shared httpx
+    # pool stalls for seconds under this much concurrency and would end up
+    # measuring the client instead of the server.
+    async def user(deadline):
+        nonlocal errors
+        async with httpx.AsyncClient(base_url=base, timeout=30) as client:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    r = await client.get(f'/stops/{random.choice(ids)}')
+                    ok = r.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[user(deadline) for _ in range(concurrency)])
+    return latencies, errors
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else (values or [0])[0]
+
+
+def bench(mode, args, vbb):
+    proc, base = start(mode, vbb)
+    try:
+        ids = seed(base, [f'bench {i}' for i in range(args.stops // 5)])
+        latencies, errors = asyncio.run(drive(base, ids, args.concurrency, args.duration))
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {
+        'mode': mode,
+        'concurrency': args.concurrency,
+        'upstream_latency_ms': args.latency,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / args.duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serving mode throughput')
+    parser.add_argument('--mode', choices=[*COMMANDS, 'both', 'all'], default='both')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--latency', type=float, default=100, help='stand-in latency in milliseconds')
+    parser.add_argument('--stops', type=int, default=50)
+    args = parser.parse_args()
+
+    standin, vbb = start_standin(args.latency)
+    modes = {'both': ['sync', 'async'], 'all': list(COMMANDS)}.get(args.mode, [args.mode])
+    try:
+        for mode in modes:
+            print(json.dumps(bench(mode, args, vbb)))
+    finally:
+        standin.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# k-nearest stops within a radius: the R*Tree-backed geo.nearby against a
+# naive full scan of the stops table, on --stops random points around Berlin.
+#
+#   python bench/nearby.py --stops 100000 --queries 2000 --radius 500 --k 10
+
+import argparse
+import heapq
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+import geo
+
+BERLIN = (52.34, 52.68, 13.09, 13.76)
+
+
+def populate(pool, n):
+    min_lat, max_lat, min_lon, max_lon = BERLIN
+    rows = []
+    for sid in random.sample(range(900000000, 999999999), n):
+        rows.append((sid, f'Stop {sid}', random.uniform(min_lat, max_lat), random.uniform(min_lon, max_lon),
+                     '2025-03-08-12:00:40', f'http://127.0.0.1:5000/stops/{sid}'))
+    with pool.transaction() as con:
+        con.executemany(db.STOP_INSERT, rows)
+
+
+def full_scan(con, lat, lon, radius, k):
+    hits = []
+    for row in con.execute("SELECT stop_id, name, latitude, longitude, link FROM stops"):
+        d = geo.distance(lat, lon, row[2], row[3])
+        if d <= radius:
+            hits.append((d, row))
+    return heapq.nsmallest(k, hits, key=lambda hit: hit[0])
+
+
+def timed(fn, con, points, radius, k):
+    samples = []
+    for lat, lon in points:
+        start = time.perf_counter()
+        fn(con, lat, lon, radius, k)
+        samples.append(time.perf_counter() - start)
+    return {
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'p99_ms': round(statistics.quantiles(samples, n=100)[98] * 1000, 3) if len(samples) > 1 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nearby stops: R*Tree vs full scan')
+    parser.add_argument('--stops', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--scan-queries', type=int, default=20)
+    parser.add_argument('--radius', type=float, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    pool = db.Pool(os.path.join(tempfile.mkdtemp(), 'bench.db'), size=1)
+    populate(pool, args.stops)
+    min_lat, max_lat, min_lon, max_lon = BERLIN
+    points = [(random.uniform(min_lat, max_lat), random.uniform(min_lon, max_lon)) for _ in range(args.queries)]
+
+    with pool.connection() as con:
+        for lat, lon in points[:args.scan_queries]:
+            assert [row for _, row in geo.nearby(con, lat, lon, args.radius, args.k)] == \
+                   [row for _, row in full_scan(con, lat, lon, args.radius, args.k)]
+        result = {'stops': args.stops, 'radius': args.radius, 'k': args.k,
+                  'rtree': timed(geo.nearby, con, points, args.radius, args.k),
+                  'full_scan': timed(full_scan, con, points[:args.scan_queries], args.radius, args.k)}
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Latency of hydrating one stop together with its next/prev neighbours:
+# the old three string-compared queries against the single STOP_HYDRATE
+# statement, on a table of --stops rows.
+#
+#   python bench/neighbours.py --stops 200000 --lookups 20000
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+
+OLD = [
+    "SELECT depa, depa_time, time, name, latitude, longitude, link FROM stops WHERE stop_id='{0}'",
+    "SELECT stop_id FROM stops WHERE stop_id > '{0}' ORDER BY stop_id LIMIT 1",
+    "SELECT stop_id FROM stops WHERE stop_id < '{0}' ORDER BY stop_id DESC LIMIT 1",
+]
+
+
+def populate(pool, n):
+    ids = random.sample(range(900000000, 999999999), n)
+    rows = [(sid, f'Stop {sid}', 52.3 + random.random() / 2, 13.1 + random.random() / 2,
+             '2025-03-08-12:00:40', f'http://127.0.0.1:5000/stops/{sid}') for sid in ids]
+    with pool.transaction() as con:
+        con.executemany(db.STOP_INSERT, rows)
+    return ids
+
+
+def old_lookup(con, sid):
+    return [con.execute(sql.format(sid)).fetchone() for sql in OLD]
+
+
+def new_lookup(con, sid):
+    return con.execute(db.STOP_HYDRATE, (sid,)).fetchone()
+
+
+def timed(fn, con, ids):
+    samples = []
+    for sid in ids:
+        start = time.perf_counter()
+        fn(con, sid)
+        samples.append(time.perf_counter() - start)
+    return {
+        'mean_us': round(statistics.fmean(samples) * 1e6, 2),
+        'p50_us': round(statistics.median(samples) * 1e6, 2),
+        'p99_us': round(statistics.quantiles(samples, n=100)[98] * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stop + neighbour lookup latency')
+    parser.add_argument('--stops', type=int, default=200000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    pool = db.Pool(os.path.join(tempfile.mkdtemp(), 'bench.db'), size=1)
+    ids = populate(pool, args.stops)
+    sample = random.choices(ids, k=args.lookups)
+    with pool.connection() as con:
+        row, after, before = old_lookup(con, sample[0])
+        assert new_lookup(con, sample[0]) == row + (after and after[0], before and before[0])
+        for fn in (old_lookup, new_lookup):
+            timed(fn, con, sample[:1000])
+        result = {'stops': args.stops, 'lookups': args.lookups,
+                  'three_queries': timed(old_lookup, con, sample),
+                  'single_query': timed(new_lookup, con, sample)}
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
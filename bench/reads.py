@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# GET /stops/<id> when every read refreshes the stored departure: --threads
+# request threads in one process, with the refresh written by the request
+# (WRITE_BEHIND_INTERVAL=0) and written behind. Departures come from the
+# cache, so the database is what differs. Reports throughput, latency and
+# the db phase taken from Server-Timing.
+#
+#   python bench/reads.py --threads 8 --duration 5
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import vbb_standin
+
+
+def ms(values, p):
+    return round(statistics.quantiles(values, n=100)[p - 1] * 1000, 2) if len(values) > 1 else None
+
+
+def drive(app, ids, threads, duration):
+    latencies, db_seconds = [], []
+
+    def user(deadline):
+        client = app.app.test_client()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            r = client.get(f'/stops/{random.choice(ids)}')
+            latencies.append(time.perf_counter() - start)
+            timing = dict(part.split(';dur=') for part in r.headers.get('Server-Timing', '').split(', ') if part)
+            db_seconds.append(float(timing.get('db', 0)) / 1000)
+            r.close()
+
+    deadline = time.perf_counter() + duration
+    workers = [threading.Thread(target=user, args=(deadline,)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {'rps': round(len(latencies) / duration, 1), 'p50_ms': ms(latencies, 50), 'p99_ms': ms(latencies, 99),
+            'db_p50_ms': ms(db_seconds, 50), 'db_p99_ms': ms(db_seconds, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read throughput with and without write-behind')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--stops', type=int, default=100)
+    args = parser.parse_args()
+
+    server = vbb_standin.serve(latency=0)
+    os.environ.update(VBB_BASE_URL=f'http://127.0.0.1:{server.server_port}', GOOGLE_API_KEY='bench', PREFETCH='0',
+                      ADMISSION='0', CHANGES_COMPACT_INTERVAL='0', DEPARTURES_MAX_AGE='0', DEPARTURES_TTL='3600')
+    os.chdir(tempfile.mkdtemp())
+    import app
+
+    client = app.app.test_client()
+    client.post('/stops/bulk', json=[{'query': f'bench {i}'} for i in range(args.stops // 5)]).get_data()
+    ids = [stop['stop_id'] for stop in client.get('/stops?limit=1000').get_json()['stops']]
+    if not ids:
+        sys.exit('no stops could be imported from the VBB stand-in')
+    for sid in ids:
+        client.get(f'/stops/{sid}').close()
+
+    result = {'stops': len(ids), 'threads': args.threads}
+    for name, interval in (('write-through', 0), ('write-behind', 1)):
+        app.writes.flush()
+        app.writes.interval = interval
+        before = app.writes.metrics()
+        result[name] = drive(app, ids, args.threads, args.duration)
+        after = app.writes.metrics()
+        result[name]['transactions'] = after['flushes'] - before['flushes']
+        result[name]['rows_written'] = after['written'] - before['written']
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Local stop-name search (search.stops over the FTS5 indexes) against the
+# VBB /locations round trip it replaces, on --stops generated stop names.
+# Prefix queries hit the word index, typo queries the trigram fallback.
+# The round trip goes to the local stand-in with --latency added, or to the
+# API given by --vbb.
+#
+#   python bench/search.py --stops 50000 --queries 2000 --latency 100
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+import search
+import vbb_standin
+
+SYLLABLES = ['al', 'ex', 'an', 'der', 'platz', 'haupt', 'bahn', 'hof', 'zoo', 'gar', 'ten', 'fried',
+             'rich', 'ost', 'kreuz', 'war', 'schau', 'er', 'hack', 'markt', 'pots', 'dam', 'ge', 'sund',
+             'brun', 'nen', 'span', 'dau', 'schoe', 'ne', 'wei', 'de', 'wann', 'see', 'tem', 'pel', 'koelln',
+             'pan', 'kow', 'lich', 'ten', 'berg', 'stra', 'sse', 'weg', 'damm', 'allee', 'feld', 'dorf']
+PREFIXES = ['S', 'U', 'S+U', 'Bus', 'Tram']
+# Street-like words in roughly the number of distinct words VBB stop names use.
+WORDS = sorted({''.join(random.sample(SYLLABLES, 3)).title() for _ in range(3000)})
+
+
+def populate(pool, n):
+    rows = []
+    for sid in random.sample(range(900000000, 999999999), n):
+        name = f'{random.choice(PREFIXES)} {random.choice(WORDS)}/{random.choice(WORDS)}'
+        rows.append((sid, name, 52.5, 13.4, '2025-03-08-12:00:40', f'http://127.0.0.1:5000/stops/{sid}'))
+    with pool.transaction() as con:
+        con.executemany(db.STOP_INSERT, rows)
+
+
+def typo(word):
+    i = random.randrange(1, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def summary(samples):
+    return {
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'p99_ms': round(statistics.quantiles(samples, n=100)[98] * 1000, 3) if len(samples) > 1 else None,
+    }
+
+
+def timed(con, queries):
+    samples, hits = [], 0
+    for query in queries:
+        start = time.perf_counter()
+        hits += bool(search.stops(con, query))
+        samples.append(time.perf_counter() - start)
+    return dict(summary(samples), hit_rate=round(hits / len(queries), 3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stop search vs VBB /locations')
+    parser.add_argument('--stops', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--upstream-queries', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=100, help='stand-in latency in milliseconds')
+    parser.add_argument('--vbb', help='base URL of a real VBB API to time instead of the stand-in')
+    args = parser.parse_args()
+
+    pool = db.Pool(os.path.join(tempfile.mkdtemp(), 'bench.db'), size=1)
+    populate(pool, args.stops)
+    prefix = [random.choice(WORDS)[:random.randint(3, 8)] for _ in range(args.queries)]
+    typos = [typo(random.choice(WORDS)) for _ in range(args.queries)]
+    misses = [f'Nowhere{i}' for i in range(args.queries)]
+
+    base = args.vbb
+    if base is None:
+        server = vbb_standin.serve(latency=args.latency / 1000)
+        base = f'http://127.0.0.1:{server.server_port}'
+    samples = []
+    with httpx.Client(base_url=base, timeout=30) as client:
+        for query in prefix[:args.upstream_queries]:
+            start = time.perf_counter()
+            client.get('/locations', params={'query': query, 'results': '5'}).raise_for_status()
+            samples.append(time.perf_counter() - start)
+
+    with pool.connection() as con:
+        result = {'stops': args.stops,
+                  'local_prefix': timed(con, prefix),
+                  'local_typo': timed(con, typos),
+                  'local_miss': timed(con, misses),
+                  'upstream': dict(summary(samples), url=base)}
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
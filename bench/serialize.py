@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Serialization cost per endpoint: the body of each endpoint, taken from a
+# running app with --stops stand-in stops, is encoded with every available
+# JSON encoder and compressed with every available coding. For
+# GET /stops/<id> the full request is also timed with and without a
+# matching If-None-Match.
+#
+#   python bench/serialize.py --stops 2000 --repeat 200
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import vbb_standin
+
+
+def us(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return round(statistics.median(samples) * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON encoding and compression cost per endpoint')
+    parser.add_argument('--stops', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    server = vbb_standin.serve(latency=0)
+    os.environ.update(VBB_BASE_URL=f'http://127.0.0.1:{server.server_port}', GOOGLE_API_KEY='bench', PREFETCH='0',
+                      CHANGES_COMPACT_INTERVAL='0')
+    os.chdir(tempfile.mkdtemp())
+    import app
+    import codec
+    import compress
+
+    client = app.app.test_client()
+    queries = [{'query': f'bench {i}'} for i in range(args.stops // 5)]
+    summary = json.loads(client.post('/stops/bulk', json=queries).get_data().splitlines()[-1])['summary']
+    ids = [stop['stop_id'] for stop in client.get('/stops?limit=1000').get_json()['stops']]
+    sid = ids[len(ids) // 2]
+    paths = {
+        'GET /stops?limit=1000': '/stops?limit=1000',
+        'GET /stops/<id>': f'/stops/{sid}',
+        'GET /stops/<id>?n=20': f'/stops/{sid}?n=20',
+        'GET /stops/departures (50 ids)': '/stops/departures?ids=' + ','.join(map(str, ids[:50])),
+        'GET /stops/changes?limit=1000': '/stops/changes?limit=1000',
+        'GET /stops/nearby?k=50': '/stops/nearby?lat=52.5&lon=13.4&radius=5000&k=50',
+    }
+
+    result = {'stops': summary['stops'], 'encoders': list(codec.ENCODERS), 'codings': list(compress.CODINGS),
+              'endpoints': {}}
+    for name, path in paths.items():
+        body = client.get(path).get_json()
+        raw = json.dumps(body).encode()
+        row = {'bytes': len(raw)}
+        for encoder, (dumps, _) in codec.ENCODERS.items():
+            row[f'{encoder}_us'] = us(lambda: dumps(body), args.repeat)
+        for coding, compressor in compress.CODINGS.items():
+            row[f'{coding}_bytes'] = len(compressor().finish(raw))
+            row[f'{coding}_us'] = us(lambda: compressor().finish(raw), args.repeat)
+        result['endpoints'][name] = row
+
+    path = paths['GET /stops/<id>']
+    etag = client.get(path).headers['ETag']
+    result['GET /stops/<id> request_us'] = {
+        '200': us(lambda: client.get(path).get_data(), args.repeat),
+        '304': us(lambda: client.get(path, headers={'If-None-Match': etag}).get_data(), args.repeat),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Cheap reads during a burst of guides: --guides clients request /guide in
+# a loop while --readers clients read GET /stops/<id>, against one gunicorn
+# worker with GUNICORN_THREADS threads, with admission control on and off.
+# Reports the latency of the reads and the status codes of both.
+#
+#   python bench/shedding.py --guides 32 --readers 4 --gemini-latency 2000
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import httpx
+
+import gemini_standin
+import vbb_standin
+from load import percentile, start
+
+
+async def drive(base, guides, readers, ids, duration):
+    reads, statuses = [], {'guide': {}, 'read': {}}
+
+    async def user(kind, client_id, deadline):
+        async with httpx.AsyncClient(base_url=base, timeout=120, headers={'X-Client': client_id}) as client:
+            while time.perf_counter() < deadline:
+                path = '/guide' if kind == 'guide' else f'/stops/{random.choice(ids)}'
+                began = time.perf_counter()
+                try:
+                    r = await client.get(path)
+                    status = r.status_code
+                except httpx.HTTPError:
+                    status = 'error'
+                statuses[kind][status] = statuses[kind].get(status, 0) + 1
+                if kind == 'read' and status == 200:
+                    reads.append(time.perf_counter() - began)
+                if kind == 'guide' and status in (429, 503):
+                    await asyncio.sleep(float(r.headers.get('Retry-After', 1)))
+
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[user('guide', f'guide-{i}', deadline) for i in range(guides)],
+                         *[user('read', f'read-{i}', deadline) for i in range(readers)])
+    return {
+        'reads_per_second': round(len(reads) / duration, 1),
+        'read_p50_ms': round(percentile(reads, 50) * 1000, 1),
+        'read_p99_ms': round(percentile(reads, 99) * 1000, 1),
+        'statuses': {kind: {str(k): v for k, v in sorted(s.items(), key=str)} for kind, s in statuses.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cheap read latency during a burst of guides')
+    parser.add_argument('--guides', type=int, default=32)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--gemini-latency', type=float, default=2000, help='milliseconds to the first chunk')
+    args = parser.parse_args()
+
+    vbb = vbb_standin.serve(latency=0.02)
+    gemini = gemini_standin.serve(latency=args.gemini_latency / 1000, chunk_latency=0.05)
+    result = {}
+    for admission in ('0', '1'):
+        env = {'GEMINI_BASE_URL': f'http://127.0.0.1:{gemini.server_port}', 'GUIDE_TTL': '0', 'ADMISSION': admission,
+               'WEB_CONCURRENCY': '1', 'GUNICORN_THREADS': str(args.threads), 'GUNICORN_TIMEOUT': '120',
+               'RATE_LIMIT_CLIENT_HEADER': 'X-Client', 'DEPARTURES_TTL': '30'}
+        proc, base = start('gunicorn', f'http://127.0.0.1:{vbb.server_port}', env)
+        try:
+            httpx.put(base + '/stops', params={'query': 'alexanderplatz', 'source': 'vbb'}, timeout=30)
+            ids = [stop['stop_id'] for stop in httpx.get(base + '/stops', timeout=30).json()['stops']]
+            if not ids:
+                sys.exit('no stops could be imported from the VBB stand-in')
+            name = 'admission on' if admission == '1' else 'admission off'
+            result[name] = asyncio.run(drive(base, args.guides, args.readers, ids, args.duration))
+            print(json.dumps({name: result[name]}), file=sys.stderr)
+        finally:
+            proc.terminate()
+            proc.wait()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Cold start of the API, each measurement in a fresh interpreter:
+#
+#   import         time to import app.py
+#   genai_import   what importing the Gemini SDK up front would add
+#   first_request  first /swagger.json and /stops after the import, with the
+#                  spec generated from the models or read from SWAGGER_FILE
+#   ready          process start until the server answers its first request
+#
+#   python bench/startup.py --runs 5
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from load import COMMANDS, free_port, root
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.get('/swagger.json')
+swagger = time.perf_counter()
+client.get('/stops')
+stops = time.perf_counter()
+print(json.dumps({'import': imported - start, 'swagger': swagger - imported, 'stops': stops - swagger}))
+"""
+
+
+def env(**extra):
+    return dict(os.environ, GOOGLE_API_KEY='bench', PREFETCH='0', PYTHONPATH=root, **extra)
+
+
+def probe(extra):
+    out = subprocess.run([sys.executable, '-c', PROBE], cwd=tempfile.mkdtemp(), env=env(**extra),
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out)
+
+
+def genai_import():
+    out = subprocess.run([sys.executable, '-c', 'import time; t = time.perf_counter(); from google import genai; '
+                          'print(time.perf_counter() - t)'], capture_output=True, text=True, check=True).stdout
+    return float(out)
+
+
+def ready(mode):
+    port = free_port()
+    cmd = [arg.format(port=port) for arg in COMMANDS[mode]]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=tempfile.mkdtemp(), env=env(PORT=str(port), WEB_CONCURRENCY='1'),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                httpx.get(f'http://127.0.0.1:{port}/stops', timeout=5).raise_for_status()
+                return time.perf_counter() - start
+            except httpx.HTTPError:
+                time.sleep(0.005)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def ms(samples):
+    return round(statistics.median(samples) * 1000, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import and first-request latency of app.py')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    swagger_file = os.path.join(tempfile.mkdtemp(), 'swagger.json')
+    subprocess.run([sys.executable, os.path.join(root, 'app.py'), '--write-swagger', swagger_file],
+                   cwd=tempfile.mkdtemp(), env=env(), check=True)
+
+    generated = [probe({}) for _ in range(args.runs)]
+    precomputed = [probe({'SWAGGER_FILE': swagger_file}) for _ in range(args.runs)]
+    result = {
+        'runs': args.runs,
+        'import_ms': ms([run['import'] for run in generated]),
+        'genai_import_ms': ms([genai_import() for _ in range(args.runs)]),
+        'first_swagger_ms': {'generated': ms([run['swagger'] for run in generated]),
+                             'precomputed': ms([run['swagger'] for run in precomputed])},
+        'first_stops_ms': ms([run['stops'] for run in generated]),
+        'ready_ms': {mode: ms([ready(mode) for _ in range(args.runs)]) for mode in ('sync', 'gunicorn')},
+    }
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Offline benchmark suite: the API runs against the VBB stand-in, replaying
+# a recording (see vbb_standin.py --record) or generating payloads, and the
+# Gemini stand-in with canned answers, both with injected latency. Each
+# scenario is driven by --concurrency users for --duration seconds, and
+# p50/p95/p99 latency and throughput are written to --output as JSON, with
+# the commit they were measured on. Every scenario first runs --warmup
+# seconds untimed, so per-worker caches and connections are set up. Given
+# --baseline, the change against an earlier result file is printed too.
+#
+#   python bench/suite.py --output before.json
+#   git checkout other && python bench/suite.py --output after.json --baseline before.json
+#   python bench/suite.py --replay vbb.jsonl --vbb-latency 80 --gemini-latency 400
+#
+# Departures are not cached and not prefetched, and guides are not reused,
+# so every GET /stops/<id> and /guide goes upstream. Operator profiles are
+# generated once and then served from the database, as in production.
+# Admission control is off, as all users come from one address; see
+# bench/shedding.py for its effect.
+
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+import gemini_standin
+import vbb_standin
+from load import COMMANDS, percentile, root, start
+
+QUERIES = ['alexanderplatz', 'hauptbahnhof', 'zoologischer garten', 'friedrichstrasse', 'ostkreuz',
+           'warschauer strasse', 'hackescher markt', 'potsdamer platz', 'gesundbrunnen', 'suedkreuz']
+
+
+def scenarios(ids):
+    return {
+        'PUT /stops': lambda: ('PUT', '/stops', {'query': random.choice(QUERIES)}),
+        'GET /stops': lambda: ('GET', '/stops', {'limit': '100'}),
+        'GET /stops/<id>': lambda: ('GET', f'/stops/{random.choice(ids)}', None),
+        'GET /operator-profiles/<id>': lambda: ('GET', f'/operator-profiles/{random.choice(ids)}', None),
+        'GET /guide': lambda: ('GET', '/guide', None),
+    }
+
+
+async def drive(base, request, concurrency, duration):
+    latencies, statuses = [], {}
+
+    async def user(deadline):
+        async with httpx.AsyncClient(base_url=base, timeout=60) as client:
+            while time.perf_counter() < deadline:
+                method, path, params = request()
+                start = time.perf_counter()
+                try:
+                    r = await client.request(method, path, params=params)
+                    status = r.status_code
+                except httpx.HTTPError:
+                    status = 'error'
+                statuses[status] = statuses.get(status, 0) + 1
+                if status in (200, 201):
+                    latencies.append(time.perf_counter() - start)
+
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[user(deadline) for _ in range(concurrency)])
+    return {
+        'requests': sum(statuses.values()),
+        'errors': sum(n for status, n in statuses.items() if status not in (200, 201)),
+        'statuses': {str(status): n for status, n in sorted(statuses.items(), key=str)},
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline):
+    changes = {}
+    for name, now in result['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before:
+            changes[name] = {key: f'{(now[key] - before[key]) / before[key] * 100:+.1f}%'
+                             for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms') if before.get(key)}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline latency and throughput of the main endpoints')
+    parser.add_argument('--mode', choices=list(COMMANDS), default='gunicorn')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds each scenario runs untimed first')
+    parser.add_argument('--vbb-latency', type=float, default=50, help='milliseconds')
+    parser.add_argument('--gemini-latency', type=float, default=300, help='milliseconds to the first chunk')
+    parser.add_argument('--gemini-chunk-latency', type=float, default=30, help='milliseconds between chunks')
+    parser.add_argument('--replay', help='VBB replies recorded with vbb_standin.py --record')
+    parser.add_argument('--scenario', action='append', help='run only these scenarios, repeatable')
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE passed to the API, repeatable')
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--baseline', help='earlier --output file to compare with')
+    args = parser.parse_args()
+
+    vbb = vbb_standin.serve(latency=args.vbb_latency / 1000, replay=args.replay)
+    gemini = gemini_standin.serve(latency=args.gemini_latency / 1000, chunk_latency=args.gemini_chunk_latency / 1000)
+    env = {'GEMINI_BASE_URL': f'http://127.0.0.1:{gemini.server_port}', 'DEPARTURES_MAX_AGE': '0', 'GUIDE_TTL': '0',
+           'ADMISSION': '0'}
+    env.update(arg.split('=', 1) for arg in args.env)
+    proc, base = start(args.mode, f'http://127.0.0.1:{vbb.server_port}', env)
+    try:
+        ids = []
+        for query in QUERIES:
+            r = httpx.put(base + '/stops', params={'query': query, 'source': 'vbb'}, timeout=30)
+            if r.status_code in (200, 201):
+                ids.extend(stop['stop_id'] for stop in r.json())
+        if not ids:
+            sys.exit('no stops could be imported from the VBB stand-in')
+
+        result = {
+            'commit': commit(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+            'stops': len(ids),
+            'scenarios': {},
+        }
+        for name, request in scenarios(ids).items():
+            if args.scenario and name not in args.scenario:
+                continue
+            if args.warmup > 0:
+                asyncio.run(drive(base, request, args.concurrency, args.warmup))
+            result['scenarios'][name] = asyncio.run(drive(base, request, args.concurrency, args.duration))
+            print(json.dumps({name: result['scenarios'][name]}), file=sys.stderr)
+        result['upstream_calls'] = {'gemini': gemini.calls}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(json.dumps(compare(result, json.load(f)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# A local stand-in for v6.vbb.transport.rest, serving deterministic
+# /locations and /stops/<id>/departures payloads after a configurable delay.
+# Faults can be injected: a share of replies can be 503s or slow, and
+# server.faults can be changed while it runs.
+#
+# With --record it proxies to the real API instead and appends every reply
+# to a JSON-lines file; with --replay it answers the requests found in such
+# a file from it, and the others as usual.
+#
+#   python bench/vbb_standin.py --port 3000 --latency 100
+#   python bench/vbb_standin.py --error-rate 0.2 --slow-rate 0.05 --slow 1000
+#   python bench/vbb_standin.py --record vbb.jsonl --latency 0
+#   python bench/vbb_standin.py --replay vbb.jsonl
+#   VBB_BASE_URL=http://127.0.0.1:3000 python app.py
+
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LINES = [
+    ('S5', 'S Westkreuz', 'S-Bahn Berlin GmbH'),
+    ('U2', 'S+U Pankow', 'Berliner Verkehrsbetriebe'),
+    ('RE1', 'Frankfurt (Oder)', 'DB Regio AG Nordost'),
+    ('ICE 1006', 'Hamburg Hbf', 'DB Fernverkehr AG'),
+    ('M4', 'S Hackescher Markt', 'Berliner Verkehrsbetriebe'),
+]
+
+
+def stop_ids(query, n):
+    seed = zlib.crc32(query.encode())
+    return [900000000 + (seed + i * 7919) % 99999 for i in range(n)]
+
+
+def locations(query, n):
+    out = []
+    for i, sid in enumerate(stop_ids(query, n)):
+        out.append({
+            'type': 'stop',
+            'id': str(sid),
+            'name': f'{query.title()} {i}',
+            'location': {'type': 'location', 'latitude': 52.4 + (sid % 1000) / 5000,
+                         'longitude': 13.2 + (sid % 777) / 2500},
+        })
+    return out
+
+
+def departures(stop_id, duration, count=None):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    count = count or max(1, duration // 2)
+    out = []
+    for i in range(count):
+        name, direction, operator = LINES[(stop_id + i) % len(LINES)]
+        planned = now + datetime.timedelta(minutes=i * duration / count)
+        out.append({
+            'tripId': f'1|{stop_id}|{i}',
+            'stop': {'type': 'stop', 'id': str(stop_id), 'name': f'Stop {stop_id}'},
+            'when': planned.isoformat(timespec='seconds'),
+            'plannedWhen': planned.isoformat(timespec='seconds'),
+            'delay': (i % 4) * 60 or None,
+            'platform': None if i % 3 == 0 else str(1 + i % 8),
+            'plannedPlatform': str(1 + i % 8),
+            'direction': direction,
+            'line': {'type': 'line', 'id': name.lower().replace(' ', '-'), 'name': name,
+                     'mode': 'train', 'product': 'suburban',
+                     'operator': {'type': 'operator', 'id': operator.lower().replace(' ', '-'), 'name': operator}},
+            'remarks': [],
+        })
+    return {'departures': out, 'realtimeDataUpdatedAt': int(now.timestamp())}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def do_GET(self):
+        faults = self.server.faults
+        time.sleep(self.latency)
+        if random.random() < faults['slow_rate']:
+            time.sleep(faults['slow'])
+        if random.random() < faults['error_rate']:
+            return self.reply(503, {'message': 'injected fault'})
+        url = urlparse(self.path)
+        qs = {k: v[0] for k, v in parse_qs(url.query).items()}
+        key = recording_key(url.path, qs)
+        if key in self.server.recordings:
+            return self.reply(*self.server.recordings[key])
+        if self.server.upstream is not None:
+            return self.proxy(url.path, qs)
+        parts = url.path.strip('/').split('/')
+        if parts == ['locations'] and qs.get('query'):
+            self.reply(200, locations(qs['query'], int(qs.get('results', 5))))
+        elif len(parts) == 2 and parts[0] == 'stops' and parts[1].isdigit():
+            self.reply(200, locations(parts[1], 1)[0] | {'id': parts[1]})
+        elif len(parts) == 3 and parts[0] == 'stops' and parts[2] == 'departures' and parts[1].isdigit():
+            self.reply(200, departures(int(parts[1]), int(qs.get('duration', 10))))
+        else:
+            self.reply(400, {'message': 'invalid request'})
+
+    def proxy(self, path, qs):
+        import httpx
+        r = httpx.get(self.server.upstream + path, params=qs, timeout=30)
+        try:
+            payload = r.json()
+        except ValueError:
+            payload = {'message': r.text}
+        with self.server.lock:
+            self.server.record.write(json.dumps({'path': path, 'query': qs, 'status': r.status_code,
+                                                 'body': payload}) + '\n')
+            self.server.record.flush()
+        self.reply(r.status_code, payload)
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def recording_key(path, qs):
+    return path, tuple(sorted(qs.items()))
+
+
+def load_recordings(path):
+    """Replies recorded with --record, by request."""
+    recordings = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                query = {k: str(v) for k, v in entry['query'].items()}
+                recordings[recording_key(entry['path'], query)] = (entry['status'], entry['body'])
+    return recordings
+
+
+def serve(port=0, latency=0.0, error_rate=0.0, slow_rate=0.0, slow=0.0, replay=None, record=None,
+          upstream='https://v6.vbb.transport.rest'):
+    """Start the stand-in in a daemon thread and return the server."""
+    handler = type('StandinHandler', (Handler,), {'latency': latency})
+    server = Server(('127.0.0.1', port), handler)
+    server.faults = {'error_rate': error_rate, 'slow_rate': slow_rate, 'slow': slow}
+    server.recordings = load_recordings(replay) if replay else {}
+    server.upstream = upstream.rstrip('/') if record else None
+    server.record = open(record, 'a') if record else None
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local VBB stand-in')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--latency', type=float, default=100, help='milliseconds added to every reply')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of replies that are 503s')
+    parser.add_argument('--slow-rate', type=float, default=0, help='share of replies delayed by --slow')
+    parser.add_argument('--slow', type=float, default=1000, help='milliseconds added to slow replies')
+    parser.add_argument('--replay', help='answer from replies recorded in this file')
+    parser.add_argument('--record', help='proxy to --upstream and append its replies to this file')
+    parser.add_argument('--upstream', default='https://v6.vbb.transport.rest')
+    args = parser.parse_args()
+    server = serve(args.port, args.latency / 1000, args.error_rate, args.slow_rate, args.slow / 1000,
+                   args.replay, args.record, args.upstream)
+    replaying = f', {len(server.recordings)} recorded replies' if server.recordings else ''
+    print(f'VBB stand-in on http://127.0.0.1:{server.server_port} (+{args.latency:.0f} ms{replaying})')
+    threading.Event().wait()
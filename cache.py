@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TTLCache:
+    """A bounded LRU cache whose entries expire after ``ttl`` seconds.
+
+    ``get(key, loader)`` coalesces concurrent misses: the first caller runs
+    ``loader`` while the others wait for its result, so one key never has
+    more than one load in flight, and ``get_many`` does the same for a batch
+    of keys loaded together.  Values for which ``should_cache`` returns
+    False are handed to every waiter but not stored.  Expired entries stay
+    until they are replaced or evicted, so ``peek(key, stale=True)`` can
+    still fall back to them.
+    """
+
+    def __init__(self, ttl, maxsize, should_cache=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.should_cache = should_cache or (lambda value: True)
+        self._data = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'stale': 0}
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                flight = self._flights[key] = Future()
+                self._stats['misses'] += 1
+                leader = True
+
+        if not leader:
+            return flight.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._flights[key]
+            flight.set_exception(e)
+            raise
+        with self._lock:
+            del self._flights[key]
+            if self.should_cache(value):
+                self._put(key, value)
+        flight.set_result(value)
+        return value
+
+    def get_many(self, keys, loader):
+        """``get`` for several keys: ``loader`` is called once with the keys
+        neither cached nor in flight and returns their values in that order,
+        while keys another caller is loading are waited for.  Returns a dict
+        of every key's value."""
+        values, flights, own = {}, {}, []
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                if key in values or key in flights:
+                    continue
+                entry = self._data.get(key)
+                if entry is not None and entry[0] > now:
+                    self._data.move_to_end(key)
+                    self._stats['hits'] += 1
+                    values[key] = entry[1]
+                elif key in self._flights:
+                    self._stats['coalesced'] += 1
+                    flights[key] = self._flights[key]
+                else:
+                    flights[key] = self._flights[key] = Future()
+                    self._stats['misses'] += 1
+                    own.append(key)
+
+        # Our own keys are loaded before waiting on anyone else's, so two
+        # callers waiting on each other's keys cannot deadlock.
+        if own:
+            try:
+                loaded = list(loader(own))
+            except BaseException as e:
+                with self._lock:
+                    for key in own:
+                        del self._flights[key]
+                for key in own:
+                    flights[key].set_exception(e)
+                raise
+            with self._lock:
+                for key, value in zip(own, loaded):
+                    del self._flights[key]
+                    if self.should_cache(value):
+                        self._put(key, value)
+            for key, value in zip(own, loaded):
+                flights[key].set_result(value)
+        for key, flight in flights.items():
+            values[key] = flight.result()
+        return values
+
+    def peek(self, key, stale=False):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (stale or entry[0] > time.monotonic()):
+                if entry[0] <= time.monotonic():
+                    self._stats['stale'] += 1
+                return entry[1]
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+            stats['maxsize'] = self.maxsize
+            stats['ttl'] = self.ttl
+        return stats
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import threading
+import time
+
+import db
+import leader
+import upstream
+
+changes_retention        = float(os.getenv("CHANGES_RETENTION", str(7 * 24 * 3600)))
+changes_compact_interval = float(os.getenv("CHANGES_COMPACT_INTERVAL", "300"))
+
+
+class Gone(Exception):
+    """The changes after ``since`` were partly compacted away."""
+
+    def __init__(self, horizon):
+        super().__init__(horizon)
+        self.horizon = horizon
+
+
+def since(con, seq, limit):
+    """The latest change of each stop changed after ``seq``, oldest first.
+
+    Rows are (seq, stop_id, op, changed, row) where ``row`` is the current
+    (stop_id, time, name, latitude, longitude, depa, link) of the stop, or
+    None once it is deleted.  Raises Gone if a delete after ``seq`` may have
+    been dropped by compaction; seq 0 is a full snapshot and never is.
+    """
+    horizon = con.execute(db.CHANGES_COMPACTED).fetchone()[0]
+    if 0 < seq < horizon:
+        raise Gone(horizon)
+    return [(c_seq, stop_id, op, changed, row if row[0] is not None else None)
+            for c_seq, stop_id, op, changed, *row in con.execute(db.CHANGES_SINCE, (seq, limit))]
+
+
+class Compactor:
+    """Keeps the change log at about one row per stop.
+
+    Every ``interval`` seconds the changes superseded by a later change of
+    the same stop are deleted, and so are deletes older than ``retention``
+    seconds.  A mirror that has not synced since such a delete gets a Gone
+    and has to start over from seq 0.  Only the process holding a lock on
+    ``<database>.compact.lock`` compacts; the others retry it every
+    ``interval`` seconds.
+    """
+
+    def __init__(self, pool, interval=changes_compact_interval, retention=changes_retention):
+        self.pool = pool
+        self.interval = interval
+        self.retention = retention
+        self.leader = leader.Leader(f'{pool.path}.compact.lock')
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {'leader': False, 'runs': 0, 'superseded': 0, 'expired': 0, 'errors': 0, 'last_ms': None}
+
+    def start(self):
+        """Start compacting in this process; later calls are no-ops."""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        upstream.submit(self._run())
+
+    def compact(self):
+        start = time.perf_counter()
+        with self.pool.transaction() as con:
+            superseded = con.execute(db.CHANGES_COMPACT).rowcount
+            expired = [seq for seq, in con.execute(db.CHANGES_EXPIRE, (f'-{int(self.retention)} seconds',))]
+            if expired:
+                con.execute(db.CHANGES_SET_COMPACTED, (max(expired),))
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['superseded'] += superseded
+            self._stats['expired'] += len(expired)
+            self._stats['last_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        return superseded, len(expired)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            held = self.leader.held()
+            with self._lock:
+                self._stats['leader'] = held
+            if not held:
+                continue
+            try:
+                await asyncio.to_thread(self.compact)
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+
+    def metrics(self):
+        with self.pool.connection() as con:
+            last = con.execute(db.CHANGES_LAST).fetchone()[0]
+            horizon = con.execute(db.CHANGES_COMPACTED).fetchone()[0]
+        with self._lock:
+            stats = dict(self._stats)
+        stats['last_seq'] = last
+        stats['compacted_seq'] = horizon
+        stats['interval'] = self.interval
+        stats['retention'] = self.retention
+        return stats
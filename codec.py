@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+json_encoder = os.getenv("JSON_ENCODER", "orjson")
+
+
+def _json_dumps(data):
+    return json.dumps(data).encode()
+
+
+def _orjson_dumps(data):
+    try:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # orjson only encodes 64-bit integers; json takes any int.
+        return _json_dumps(data)
+
+
+# name -> (dumps returning bytes, loads accepting bytes or str)
+ENCODERS = {'json': (_json_dumps, json.loads)}
+if orjson is not None:
+    ENCODERS['orjson'] = (_orjson_dumps, orjson.loads)
+
+
+def use(name):
+    """Encode and decode with ``name`` from now on, or with json if it is not installed."""
+    global encoder, dumps, loads
+    encoder = name if name in ENCODERS else 'json'
+    dumps, loads = ENCODERS[encoder]
+    return encoder
+
+
+use(json_encoder)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compress_min_size = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+gzip_level        = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+brotli_quality    = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE = {'application/json', 'application/x-ndjson', 'text/plain'}
+
+
+class Gzip:
+    def __init__(self):
+        self._z = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        # A sync flush per chunk, so a streamed body reaches the client as
+        # it is produced instead of when the compressor's buffer fills.
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b''):
+        return self._z.compress(data) + self._z.flush()
+
+
+class Brotli:
+    def __init__(self):
+        self._c = brotli.Compressor(quality=brotli_quality)
+
+    def chunk(self, data):
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self, data=b''):
+        return self._c.process(data) + self._c.finish()
+
+
+CODINGS = {'gzip': Gzip}
+if brotli is not None:
+    CODINGS['br'] = Brotli
+
+
+def negotiate(accept_encodings):
+    """The coding to use for a request's Accept-Encoding, or None."""
+    return accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+
+def stream(coding, chunks):
+    compressor = CODINGS[coding]()
+    for data in chunks:
+        if data:
+            yield compressor.chunk(data)
+    yield compressor.finish()
+
+
+def apply(response, coding):
+    """Compress ``response`` in place with ``coding`` when that is worth it.
+
+    Bodies smaller than COMPRESS_MIN_SIZE are sent as they are; streamed
+    bodies are compressed chunk by chunk.  A strong ETag becomes weak, as
+    the bytes sent now depend on Accept-Encoding.
+    """
+    if (response.mimetype not in COMPRESSIBLE or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if coding is None:
+        return response
+    if response.is_streamed:
+        body = response.response
+        response.response = stream(coding, response.iter_encoded())
+        if hasattr(body, 'close'):
+            response.call_on_close(body.close)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < compress_min_size:
+            return response
+        response.set_data(CODINGS[coding]().finish(data))
+    response.headers['Content-Encoding'] = coding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
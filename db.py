@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+pool_size    = int(os.getenv("DB_POOL_SIZE", "4"))
+pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+busy_timeout = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+synchronous  = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+cache_size   = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+mmap_size    = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# The largest INTEGER SQLite stores; a larger Python int cannot be bound.
+INTEGER_MAX = 2 ** 63 - 1
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS stops(stop_id INTEGER PRIMARY KEY, name TEXT, \
+     latitude REAL, longitude REAL, time TEXT, link TEXT, depa TEXT)",
+    "CREATE TABLE IF NOT EXISTS operator_profiles(operator_name TEXT PRIMARY KEY, \
+     information TEXT NOT NULL, updated REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS guides(digest TEXT PRIMARY KEY, guide TEXT NOT NULL, created REAL NOT NULL)",
+    # R*Tree over stop coordinates, kept in step with stops by triggers so
+    # every write path (PUT, bulk import, PATCH, DELETE) updates it.
+    "CREATE VIRTUAL TABLE IF NOT EXISTS stops_geo USING rtree(stop_id, min_lat, max_lat, min_lon, max_lon)",
+    "CREATE TRIGGER IF NOT EXISTS stops_geo_insert AFTER INSERT ON stops \
+     WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL BEGIN \
+     INSERT OR REPLACE INTO stops_geo VALUES(NEW.stop_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude); END",
+    "CREATE TRIGGER IF NOT EXISTS stops_geo_update AFTER UPDATE OF latitude, longitude ON stops \
+     WHEN OLD.latitude IS NOT NEW.latitude OR OLD.longitude IS NOT NEW.longitude BEGIN \
+     DELETE FROM stops_geo WHERE stop_id = OLD.stop_id; \
+     INSERT INTO stops_geo SELECT NEW.stop_id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude \
+     WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL; END",
+    "CREATE TRIGGER IF NOT EXISTS stops_geo_delete AFTER DELETE ON stops BEGIN \
+     DELETE FROM stops_geo WHERE stop_id = OLD.stop_id; END",
+    "INSERT INTO stops_geo SELECT stop_id, latitude, latitude, longitude, longitude FROM stops \
+     WHERE latitude IS NOT NULL AND longitude IS NOT NULL \
+     AND stop_id NOT IN (SELECT stop_id FROM stops_geo)",
+    # Full-text indexes over stop names, external-content so the names are
+    # not stored twice: words (for prefix matches) and trigrams (for typos).
+    "CREATE VIRTUAL TABLE IF NOT EXISTS stops_fts USING fts5(name, content='stops', content_rowid='stop_id', \
+     tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS stops_trigram USING fts5(name, content='stops', content_rowid='stop_id', \
+     tokenize='trigram', detail='none')",
+    "CREATE TRIGGER IF NOT EXISTS stops_fts_insert AFTER INSERT ON stops BEGIN \
+     INSERT INTO stops_fts(rowid, name) VALUES(NEW.stop_id, NEW.name); \
+     INSERT INTO stops_trigram(rowid, name) VALUES(NEW.stop_id, NEW.name); END",
+    "CREATE TRIGGER IF NOT EXISTS stops_fts_update AFTER UPDATE OF name ON stops \
+     WHEN OLD.name IS NOT NEW.name BEGIN \
+     INSERT INTO stops_fts(stops_fts, rowid, name) VALUES('delete', OLD.stop_id, OLD.name); \
+     INSERT INTO stops_trigram(stops_trigram, rowid, name) VALUES('delete', OLD.stop_id, OLD.name); \
+     INSERT INTO stops_fts(rowid, name) VALUES(NEW.stop_id, NEW.name); \
+     INSERT INTO stops_trigram(rowid, name) VALUES(NEW.stop_id, NEW.name); END",
+    "CREATE TRIGGER IF NOT EXISTS stops_fts_delete AFTER DELETE ON stops BEGIN \
+     INSERT INTO stops_fts(stops_fts, rowid, name) VALUES('delete', OLD.stop_id, OLD.name); \
+     INSERT INTO stops_trigram(stops_trigram, rowid, name) VALUES('delete', OLD.stop_id, OLD.name); END",
+    "INSERT INTO stops_fts(stops_fts) SELECT 'rebuild' WHERE NOT EXISTS (SELECT 1 FROM stops_fts_docsize)",
+    "INSERT INTO stops_trigram(stops_trigram) SELECT 'rebuild' WHERE NOT EXISTS (SELECT 1 FROM stops_trigram_docsize)",
+    # The lines seen departing from each stop, from the departure boards we
+    # fetch; two stops sharing a line are connected.
+    "CREATE TABLE IF NOT EXISTS stop_lines(line TEXT NOT NULL, stop_id INTEGER NOT NULL, direction TEXT NOT NULL, \
+     seen REAL NOT NULL, PRIMARY KEY (line, stop_id, direction)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS stop_lines_stop ON stop_lines(stop_id)",
+    "CREATE TRIGGER IF NOT EXISTS stop_lines_delete AFTER DELETE ON stops BEGIN \
+     DELETE FROM stop_lines WHERE stop_id = OLD.stop_id; END",
+    # Append-only change log of stops for mirrors, also written by triggers.
+    # AUTOINCREMENT keeps seq increasing even after compaction deleted the
+    # newest rows; stop_changes_compacted holds the highest seq of a delete
+    # that compaction dropped, below which a mirror cannot catch up.
+    "CREATE TABLE IF NOT EXISTS stop_changes(seq INTEGER PRIMARY KEY AUTOINCREMENT, stop_id INTEGER NOT NULL, \
+     op TEXT NOT NULL, changed TEXT NOT NULL DEFAULT (datetime('now')))",
+    "CREATE INDEX IF NOT EXISTS stop_changes_stop ON stop_changes(stop_id, seq)",
+    "CREATE TABLE IF NOT EXISTS stop_changes_compacted(id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL)",
+    "CREATE TRIGGER IF NOT EXISTS stop_changes_insert AFTER INSERT ON stops BEGIN \
+     INSERT INTO stop_changes(stop_id, op) VALUES(NEW.stop_id, 'insert'); END",
+    "CREATE TRIGGER IF NOT EXISTS stop_changes_update AFTER UPDATE ON stops \
+     WHEN OLD.name IS NOT NEW.name OR OLD.latitude IS NOT NEW.latitude OR OLD.longitude IS NOT NEW.longitude \
+     OR OLD.time IS NOT NEW.time OR OLD.link IS NOT NEW.link OR OLD.depa IS NOT NEW.depa BEGIN \
+     INSERT INTO stop_changes(stop_id, op) VALUES(NEW.stop_id, 'update'); END",
+    "CREATE TRIGGER IF NOT EXISTS stop_changes_delete AFTER DELETE ON stops BEGIN \
+     INSERT INTO stop_changes(stop_id, op) VALUES(OLD.stop_id, 'delete'); END",
+    "INSERT INTO stop_changes(stop_id, op) SELECT stop_id, 'insert' FROM stops \
+     WHERE NOT EXISTS (SELECT 1 FROM stop_changes) ORDER BY stop_id",
+]
+
+# Columns added to existing tables; a database that has one already skips it.
+MIGRATIONS = [
+    # When the stored departure was fetched, which decides whether it is
+    # still fresh. time is when the row last changed at all, so editing a
+    # name must not make an old departure look new.
+    "ALTER TABLE stops ADD COLUMN depa_time TEXT",
+]
+
+# Every statement the API runs, parameterized so sqlite3's per-connection
+# statement cache can reuse the prepared form across requests.
+STOP_EXISTS   = "SELECT stop_id FROM stops WHERE stop_id = ?"
+STOP_DEPA_ALL = "SELECT stop_id, depa, depa_time FROM stops"
+STOP_DEPA_MANY = "SELECT stop_id, depa, depa_time, time, link FROM stops WHERE stop_id IN ({})"
+STOP_SET_DEPA = "UPDATE stops SET depa = ?1, time = ?2, depa_time = ?2 WHERE stop_id = ?3"
+STOP_INSERT   = "INSERT INTO stops (stop_id, name, latitude, longitude, time, link) VALUES(?, ?, ?, ?, ?, ?)"
+# A JSON array of [stop_id, depa, time, base] refreshes, each written only
+# while the row still has the time it was based on. One statement for the
+# whole batch, so the writer gives up the GIL once instead of once a row.
+STOP_SET_DEPA_MANY = "UPDATE stops SET depa = json_extract(r.value, '$[1]'), time = json_extract(r.value, '$[2]'), \
+                      depa_time = json_extract(r.value, '$[2]') FROM json_each(?) r WHERE stops.stop_id = json_extract(r.value, '$[0]') \
+                      AND stops.time IS json_extract(r.value, '$[3]')"
+STOP_UPSERT   = "INSERT INTO stops (stop_id, name, latitude, longitude, time, link) VALUES(?, ?, ?, ?, ?, ?) \
+                 ON CONFLICT(stop_id) DO UPDATE SET name = excluded.name, latitude = excluded.latitude, \
+                 longitude = excluded.longitude, time = excluded.time, link = excluded.link"
+STOP_EXISTING = "SELECT stop_id FROM stops WHERE stop_id IN ({})"
+# The row and its neighbours in one statement. Each subquery is a single
+# seek on the stop_id primary key, so the cost does not grow with the table.
+STOP_HYDRATE  = "SELECT s.depa, s.depa_time, s.time, s.name, s.latitude, s.longitude, s.link, \
+                 (SELECT n.stop_id FROM stops n WHERE n.stop_id > s.stop_id ORDER BY n.stop_id LIMIT 1), \
+                 (SELECT p.stop_id FROM stops p WHERE p.stop_id < s.stop_id ORDER BY p.stop_id DESC LIMIT 1) \
+                 FROM stops s WHERE s.stop_id = ?"
+STOP_NEARBY   = "SELECT s.stop_id, s.name, s.latitude, s.longitude, s.link FROM stops_geo g \
+                 JOIN stops s ON s.stop_id = g.stop_id \
+                 WHERE g.min_lat <= ? AND g.max_lat >= ? AND g.min_lon <= ? AND g.max_lon >= ?"
+STOP_PAGE     = "SELECT stop_id, time, name, latitude, longitude, depa, link FROM stops \
+                 WHERE stop_id > ? ORDER BY stop_id LIMIT ?"
+STOP_ROWS     = "SELECT stop_id, time, name, latitude, longitude, depa, link FROM stops WHERE stop_id IN ({})"
+STOP_DELETE   = "DELETE FROM stops WHERE stop_id = ?"
+STOP_NAMES    = "SELECT name FROM stops"
+STOP_SEARCH   = "SELECT rowid, name FROM stops_fts WHERE stops_fts MATCH ? ORDER BY rank LIMIT ?"
+STOP_SEARCH_TRIGRAM = "SELECT rowid, name FROM stops_trigram WHERE stops_trigram MATCH ? ORDER BY rank LIMIT ?"
+# One statement for every PATCH: a NULL parameter keeps the stored value.
+# The departure's own time only moves when a departure is written.
+STOP_PATCH    = "UPDATE stops SET name = COALESCE(?1, name), depa = COALESCE(?2, depa), \
+                 latitude = COALESCE(?3, latitude), longitude = COALESCE(?4, longitude), time = ?5, \
+                 depa_time = CASE WHEN ?2 IS NULL THEN depa_time ELSE ?5 END WHERE stop_id = ?6"
+
+# The latest change of every stop changed after seq ?, with its current row.
+CHANGES_SINCE = "SELECT c.seq, c.stop_id, c.op, c.changed, s.stop_id, s.time, s.name, s.latitude, s.longitude, \
+                 s.depa, s.link FROM stop_changes c LEFT JOIN stops s ON s.stop_id = c.stop_id \
+                 WHERE c.seq > ? AND c.seq = (SELECT MAX(m.seq) FROM stop_changes m WHERE m.stop_id = c.stop_id) \
+                 ORDER BY c.seq LIMIT ?"
+CHANGES_LAST = "SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'stop_changes'"
+CHANGES_COMPACTED = "SELECT COALESCE(MAX(seq), 0) FROM stop_changes_compacted"
+CHANGES_COMPACT = "DELETE FROM stop_changes WHERE seq NOT IN (SELECT MAX(seq) FROM stop_changes GROUP BY stop_id)"
+CHANGES_EXPIRE = "DELETE FROM stop_changes WHERE op = 'delete' AND changed < datetime('now', ?) RETURNING seq"
+CHANGES_SET_COMPACTED = "INSERT INTO stop_changes_compacted (id, seq) VALUES(1, ?) \
+                         ON CONFLICT(id) DO UPDATE SET seq = MAX(seq, excluded.seq)"
+
+LINES_UPSERT  = "INSERT INTO stop_lines (line, stop_id, direction, seen) VALUES(?, ?, ?, ?) \
+                 ON CONFLICT(line, stop_id, direction) DO UPDATE SET seen = excluded.seen"
+LINES_EXPIRE  = "DELETE FROM stop_lines WHERE stop_id = ? AND seen < ?"
+# The same for a JSON array of [line, stop_id, direction, seen] rows, and
+# for a JSON array of stop ids; rows of stops deleted meanwhile are skipped.
+LINES_UPSERT_MANY = "INSERT INTO stop_lines (line, stop_id, direction, seen) \
+                     SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]'), \
+                     json_extract(value, '$[3]') FROM json_each(?) \
+                     WHERE json_extract(value, '$[1]') IN (SELECT stop_id FROM stops) \
+                     ON CONFLICT(line, stop_id, direction) DO UPDATE SET seen = excluded.seen"
+LINES_EXPIRE_MANY = "DELETE FROM stop_lines WHERE seen < ? AND stop_id IN (SELECT value FROM json_each(?))"
+LINES_RANGE   = "SELECT (SELECT MIN(stop_id) FROM stop_lines), (SELECT MAX(stop_id) FROM stop_lines)"
+# Up to ? pairs of stored stops both served by a line seen since ?, the
+# first of them from stop id ? up.
+LINES_PAIRS   = "SELECT a.stop_id, sa.name, b.stop_id, sb.name, a.line, a.direction FROM stop_lines a \
+                 JOIN stop_lines b ON b.line = a.line AND b.stop_id > a.stop_id \
+                 JOIN stops sa ON sa.stop_id = a.stop_id JOIN stops sb ON sb.stop_id = b.stop_id \
+                 WHERE a.stop_id >= ? AND a.seen > ? AND b.seen > ? \
+                 AND sa.name IS NOT NULL AND sb.name IS NOT NULL LIMIT ?"
+
+PROFILE_SELECT = "SELECT operator_name, information, updated FROM operator_profiles WHERE operator_name IN ({})"
+PROFILE_UPSERT = "INSERT INTO operator_profiles (operator_name, information, updated) VALUES(?, ?, ?) \
+                  ON CONFLICT(operator_name) DO UPDATE SET information = excluded.information, updated = excluded.updated"
+
+
+GUIDE_SELECT  = "SELECT guide FROM guides WHERE digest = ? AND created > ?"
+GUIDE_UPSERT  = "INSERT OR REPLACE INTO guides (digest, guide, created) VALUES(?, ?, ?)"
+
+def placeholders(n):
+    return ', '.join('?' * n)
+
+
+def existing(con, ids, chunk=500):
+    """The subset of ``ids`` that are stored in the stops table."""
+    found = set()
+    for i in range(0, len(ids), chunk):
+        part = ids[i:i + chunk]
+        found.update(row[0] for row in con.execute(STOP_EXISTING.format(placeholders(len(part))), part))
+    return found
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Pool:
+    """A small per-process pool of SQLite connections.
+
+    Connections are opened lazily up to ``size`` and handed out LIFO so the
+    warmest connection (hot page cache, prepared statements) is reused first.
+    The pool notices a fork and starts over in the child, so it is safe to
+    build it before gunicorn forks its workers.  ``timer``, if given, is a
+    context manager factory wrapped around every checkout.
+    """
+
+    def __init__(self, path, size=pool_size, timeout=pool_timeout, timer=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.timer = timer or nullcontext
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._schema_ready = False
+        self._stats = {
+            'checkouts': 0,
+            'in_use': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'timeouts': 0,
+            'busy_errors': 0,
+        }
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=busy_timeout / 1000,
+                              check_same_thread=False, cached_statements=256)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA synchronous={synchronous}")
+        con.execute(f"PRAGMA cache_size=-{cache_size}")
+        con.execute(f"PRAGMA mmap_size={mmap_size}")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute(f"PRAGMA busy_timeout={busy_timeout}")
+        if not self._schema_ready:
+            with con:
+                for stmt in SCHEMA:
+                    con.execute(stmt)
+                for stmt in MIGRATIONS:
+                    try:
+                        con.execute(stmt)
+                    except sqlite3.OperationalError as e:
+                        if 'duplicate column' not in str(e):
+                            raise
+            self._schema_ready = True
+        return con
+
+    def _checkout(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._opened -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PoolTimeout(f"No database connection free after {self.timeout}s")
+
+    @contextmanager
+    def connection(self):
+        with self.timer():
+            with self._connection() as con:
+                yield con
+
+    @contextmanager
+    def _connection(self):
+        start = time.perf_counter()
+        con = self._checkout()
+        waited = time.perf_counter() - start
+        pid = self._pid
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_seconds'] += waited
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], waited)
+        try:
+            yield con
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                with self._lock:
+                    self._stats['busy_errors'] += 1
+            raise
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            with self._lock:
+                if pid == self._pid:
+                    self._stats['in_use'] -= 1
+                    self._idle.put(con)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as con:
+            try:
+                yield con
+                con.commit()
+            except BaseException:
+                con.rollback()
+                raise
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['opened'] = self._opened
+            stats['idle'] = self._idle.qsize()
+        return stats
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import heapq
+import math
+
+import db
+
+EARTH_RADIUS = 6371008.8
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lon, radius):
+    dlat = radius / METRES_PER_DEGREE
+    dlon = radius / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+def nearby(con, lat, lon, radius, k):
+    """The ``k`` stored stops closest to (lat, lon) within ``radius`` metres.
+
+    The R*Tree narrows the search to the bounding box of the circle; exact
+    distances are only computed for the stops inside it.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius)
+    rows = con.execute(db.STOP_NEARBY, (max_lat, min_lat, max_lon, min_lon))
+    hits = []
+    for row in rows:
+        d = distance(lat, lon, row[2], row[3])
+        if d <= radius:
+            hits.append((d, row))
+    return heapq.nsmallest(k, hits, key=lambda hit: hit[0])
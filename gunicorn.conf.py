@@ -0,0 +1,38 @@
+# Production server settings, read by:
+#
+#   gunicorn -c gunicorn.conf.py app:app                                      (threads)
+#   gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:application  (async)
+#
+# The app is imported once in the master and forked into the workers, so
+# they share its code pages and start quickly.  As the master keeps the
+# loaded code, kill -HUP <master> only restarts the workers on the same
+# code.  To deploy new code without dropping requests, start a new master
+# with kill -USR2 <master>, then stop the old workers with kill -WINCH
+# <old master> and the old master with kill -QUIT <old master>.  With
+# GUNICORN_PRELOAD=0 each worker imports the app itself and HUP reloads it.
+
+import multiprocessing
+import os
+
+bind               = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers            = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count() * 2 + 1)))
+threads            = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_class       = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+preload_app        = os.getenv("GUNICORN_PRELOAD", "1") != "0"
+keepalive          = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+timeout            = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout   = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+max_requests       = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+backlog            = int(os.getenv("GUNICORN_BACKLOG", "2048"))
+accesslog          = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
+
+
+def worker_exit(server, worker):
+    import app
+    app.exit_worker()
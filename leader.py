@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import fcntl
+import os
+
+
+class Leader:
+    """One process among those sharing ``path``, for work that must not
+    run in every worker, such as the prefetcher and the compactor.
+
+    ``held()`` takes an exclusive lockf lock on ``path`` if it is free and
+    says whether this process holds it.  lockf locks belong to the process,
+    so a forked child never holds its parent's, and the lock is given up
+    when the process exits; another process then gets it on its next call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def held(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._fd = None
+        if self._fd is None:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError:
+                return False
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._fd = fd
+        return True
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import math
+import threading
+from collections import defaultdict
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    A series is a metric name plus a sorted tuple of label pairs.  Values are
+    kept per process, like the rest of the counters served by ``/stats``.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = defaultdict(int)
+        self._gauges = defaultdict(int)
+        self._histograms = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            self._counters[name, _key(labels)] += value
+
+    def add(self, name, labels=None, value=1):
+        with self._lock:
+            self._gauges[name, _key(labels)] += value
+
+    def set(self, name, labels=None, value=0):
+        with self._lock:
+            self._gauges[name, _key(labels)] = value
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            series = self._histograms.get((name, _key(labels)))
+            if series is None:
+                series = self._histograms[name, _key(labels)] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self, extra=()):
+        """The exposition text; ``extra`` adds (name, labels, value) gauges."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            gauges += sorted(((name, _key(labels)), value) for name, labels, value in extra)
+            histograms = sorted((key, (list(c), s, n)) for key, (c, s, n) in self._histograms.items())
+
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name][1]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{_format(labels)} {_number(value)}')
+        for (name, labels), value in gauges:
+            header(name, 'gauge')
+            lines.append(f'{name}{_format(labels)} {_number(value)}')
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{_format(labels + (("le", _number(bound)),))} {cumulative}')
+            lines.append(f'{name}_bucket{_format(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{_format(labels)} {_number(total)}')
+            lines.append(f'{name}_count{_format(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def _format(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for k, v in labels)
+    return '{' + pairs + '}'
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
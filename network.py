@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import threading
+import time
+
+import db
+
+network_ttl = float(os.getenv("NETWORK_TTL", str(7 * 24 * 3600)))
+REFRESH = 3600
+CANDIDATES = 20
+
+
+def lines(depas):
+    """The (line, direction) pairs departing in a board."""
+    return frozenset((depa.line, depa.direction) for depa in depas if depa.line and depa.direction)
+
+
+class Network:
+    """Which stored stops are served by the same line.
+
+    Built from the departure boards the API fetches anyway: ``observe``
+    records the lines of a stop's board, adding to what was seen before,
+    since a two hour board misses the lines that only run at other times.
+    Lines not seen at a stop for ``ttl`` seconds are dropped.  A board
+    whose lines this process wrote in the last hour is not written again.
+    ``write(stop_id, rows, expire_before)``, if given, takes the rows to
+    write instead, so that whoever fetched the board does not write them.
+    """
+
+    def __init__(self, pool, ttl=network_ttl, write=None):
+        self.pool = pool
+        self.ttl = ttl
+        self.write = write
+        self._lock = threading.Lock()
+        self._written = {}
+        self._stats = {'observed': 0, 'written': 0}
+
+    def observe(self, stop_id, depas):
+        seen = lines(depas)
+        now = time.time()
+        with self._lock:
+            self._stats['observed'] += 1
+            written = self._written.get(stop_id)
+            if not seen or written and written[0] >= seen and written[1] > now - REFRESH:
+                return False
+        rows = [(line, stop_id, direction, now) for line, direction in seen]
+        if self.write is not None:
+            self.write(stop_id, rows, now - self.ttl)
+        else:
+            with self.pool.transaction() as con:
+                con.executemany(db.LINES_UPSERT, rows)
+                con.execute(db.LINES_EXPIRE, (stop_id, now - self.ttl))
+        with self._lock:
+            previous = self._written.get(stop_id)
+            if previous and previous[1] > now - REFRESH:
+                seen = seen | previous[0]
+            self._written[stop_id] = (seen, now)
+            self._stats['written'] += 1
+        return True
+
+    def pairs(self, con, start=0, limit=CANDIDATES):
+        """Up to ``limit`` (stop_id, name, stop_id, name, line, direction) of
+        stops sharing a line, the first stop from id ``start`` up."""
+        since = time.time() - self.ttl
+        return con.execute(db.LINES_PAIRS, (start, since, since, limit)).fetchall()
+
+    def pair(self, con):
+        """One pair of stops sharing a line, or None.
+
+        The candidates start at a random stop id, so repeated guides are not
+        all drawn from the lowest ids.
+        """
+        low, high = con.execute(db.LINES_RANGE).fetchone()
+        if low is None:
+            return None
+        candidates = self.pairs(con, random.randint(low, high)) or self.pairs(con)
+        return random.choice(candidates) if candidates else None
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['stops_tracked'] = len(self._written)
+        stats['ttl'] = self.ttl
+        return stats
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import datetime
+import math
+import os
+import threading
+import time
+
+import db
+import leader
+import upstream
+
+prefetch_enabled     = os.getenv("PREFETCH", "1") != "0"
+prefetch_interval    = float(os.getenv("PREFETCH_INTERVAL", "45"))
+prefetch_rate        = float(os.getenv("PREFETCH_RATE", "1"))
+prefetch_concurrency = int(os.getenv("PREFETCH_CONCURRENCY", "4"))
+departures_max_age   = float(os.getenv("DEPARTURES_MAX_AGE", "60"))
+
+TIME_FORMAT = '%Y-%m-%d-%H:%M:%S'
+READS_HALF_LIFE = 600
+MAX_BACKOFF = 300
+
+
+def age(stamp):
+    """Seconds since a ``stops.time`` value, or infinity if it can't be read."""
+    try:
+        return (datetime.datetime.now() - datetime.datetime.strptime(stamp, TIME_FORMAT)).total_seconds()
+    except (TypeError, ValueError):
+        return math.inf
+
+
+class Prefetcher:
+    """Keeps the stored next departure of every stop fresh in the background.
+
+    A task on the upstream loop refreshes the stops whose ``time`` is older
+    than ``interval``, the most read first, making at most ``rate`` VBB calls
+    a second.  A 429 or 5xx answer, or VBB being unavailable, pauses the
+    scheduler for Retry-After seconds, or with exponential backoff when VBB
+    does not send one.  A rate of 0 turns it off.
+
+    One process per database runs the scheduler: the one holding a lock on
+    ``<database>.prefetch.lock``.  The others retry the lock every
+    ``interval`` seconds, so one of them takes over when it exits.  Reads
+    are counted in every process and ranked in the one scheduling, which
+    sees a share of them.
+    ``fetch`` is a coroutine function returning the httpx response for a
+    stop's departures; ``decode`` turns its body into a board, ``extract``
+    the board into the ``depa`` text, and ``observe(stop_id, board)``, if
+    given, is called with every board stored.
+    """
+
+    def __init__(self, pool, fetch, decode, extract, observe=None, interval=prefetch_interval, rate=prefetch_rate,
+                 concurrency=prefetch_concurrency, max_age=departures_max_age, enabled=prefetch_enabled):
+        self.pool = pool
+        self.fetch = fetch
+        self.decode = decode
+        self.extract = extract
+        self.observe = observe
+        self.interval = interval
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_age = max_age
+        self.enabled = enabled and rate > 0
+        self.leader = leader.Leader(f'{pool.path}.prefetch.lock')
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reads = {}
+        self._retry_at = {}
+        self._backoff = 0
+        self._resume = 0
+        self._done = collections.deque()
+        self._stats = {'leader': False, 'cycles': 0, 'due': 0, 'refreshed': 0, 'errors': 0, 'throttled': 0,
+                       'lag_seconds': 0.0, 'max_lag_seconds': 0.0}
+
+    def start(self):
+        """Start the scheduler in this process; later calls are no-ops."""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        upstream.submit(self._run())
+
+    def touch(self, stop_id):
+        """Count a read of ``stop_id``; reads decay with a ten minute half-life."""
+        now = time.monotonic()
+        with self._lock:
+            score, last = self._reads.get(stop_id, (0.0, now))
+            self._reads[stop_id] = (score * 0.5 ** ((now - last) / READS_HALF_LIFE) + 1, now)
+
+    def fresh(self, depa, stamp):
+        return bool(depa) and age(stamp) <= self.max_age
+
+    def _due(self):
+        with self.pool.connection() as con:
+            rows = con.execute(db.STOP_DEPA_ALL).fetchall()
+
+        now = time.monotonic()
+        with self._lock:
+            stored = {row[0] for row in rows}
+            self._reads = {k: v for k, v in self._reads.items() if k in stored}
+            self._retry_at = {k: v for k, v in self._retry_at.items() if v > now}
+            scores = {k: score * 0.5 ** ((now - last) / READS_HALF_LIFE) for k, (score, last) in self._reads.items()}
+            retry_at = dict(self._retry_at)
+
+        due = []
+        wake = self.interval
+        for stop_id, depa, stamp in rows:
+            if stop_id in retry_at:
+                wake = min(wake, retry_at[stop_id] - now)
+                continue
+            seconds = age(stamp) if depa else math.inf
+            if seconds >= self.interval:
+                due.append((-scores.get(stop_id, 0.0), -seconds, stop_id))
+            else:
+                wake = min(wake, self.interval - seconds)
+        due.sort()
+        return [(stop_id, -negative_age) for _, negative_age, stop_id in due], max(wake, 1)
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        batch = max(1, int(self.rate * self.interval))
+        while True:
+            held = self.leader.held()
+            with self._lock:
+                self._stats['leader'] = held
+            if not held:
+                await asyncio.sleep(self.interval)
+                continue
+            try:
+                due, wake = await asyncio.to_thread(self._due)
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+                await asyncio.sleep(self.interval)
+                continue
+            with self._lock:
+                self._stats['cycles'] += 1
+                self._stats['due'] = len(due)
+            if not due:
+                await asyncio.sleep(wake)
+                continue
+
+            # Re-rank after every batch so a stop that just got popular does
+            # not wait behind a long backlog.
+            tasks = []
+            for stop_id, seconds in due[:batch]:
+                while time.monotonic() < self._resume:
+                    await asyncio.sleep(self._resume - time.monotonic())
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(self._refresh(stop_id, seconds, semaphore)))
+                await asyncio.sleep(1 / self.rate)
+            await asyncio.gather(*tasks)
+
+    async def _refresh(self, stop_id, seconds, semaphore):
+        try:
+            r = await self.fetch(stop_id)
+            if r.status_code == 429 or r.status_code >= 500:
+                self._throttle(r.headers.get('Retry-After'))
+                return
+            self._backoff = 0
+            board = self.decode(r.content) if 200 <= r.status_code < 300 else None
+            depa = self.extract(board) if board is not None else None
+            if not depa:
+                self._skip(stop_id)
+                return
+            stamp = datetime.datetime.now().strftime(TIME_FORMAT)
+            await asyncio.to_thread(self._store, (depa, stamp, stop_id), board)
+        except upstream.Unavailable:
+            self._throttle(None)
+            return
+        except Exception:
+            self._skip(stop_id)
+            return
+        finally:
+            semaphore.release()
+
+        now = time.monotonic()
+        lag = seconds - self.interval if seconds != math.inf else 0.0
+        with self._lock:
+            self._stats['refreshed'] += 1
+            self._stats['lag_seconds'] = round(lag, 3)
+            self._stats['max_lag_seconds'] = round(max(self._stats['max_lag_seconds'], lag), 3)
+            self._done.append(now)
+
+    def _store(self, row, board):
+        with self.pool.transaction() as con:
+            con.execute(db.STOP_SET_DEPA, row)
+        if self.observe is not None:
+            self.observe(row[2], board)
+
+    def _skip(self, stop_id):
+        with self._lock:
+            self._stats['errors'] += 1
+            self._retry_at[stop_id] = time.monotonic() + self.interval
+
+    def _throttle(self, retry_after):
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            self._backoff = min(max(self._backoff * 2, 1), MAX_BACKOFF)
+            delay = self._backoff
+        with self._lock:
+            self._stats['throttled'] += 1
+            self._resume = max(self._resume, time.monotonic() + delay)
+
+    def metrics(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._done and self._done[0] < now - 60:
+                self._done.popleft()
+            stats = dict(self._stats)
+            stats['refreshed_last_minute'] = len(self._done)
+            stats['paused_seconds'] = round(max(0, self._resume - now), 3)
+            stats['tracked_reads'] = len(self._reads)
+            stats['enabled'] = self.enabled
+            stats['interval'] = self.interval
+            stats['rate'] = self.rate
+            stats['max_age'] = self.max_age
+        return stats
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+profile_token    = os.getenv("PROFILE_TOKEN", "")
+profile_dir      = os.getenv("PROFILE_DIR", "profiles")
+profile_interval = float(os.getenv("PROFILE_INTERVAL_MS", "2")) / 1000
+
+
+class Sampler:
+    """Samples the stack of one thread until stopped.
+
+    The result is written in the collapsed format (``frame;frame;frame
+    count`` per line) that flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, thread_id, interval=profile_interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self._started
+        return self
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+def requested(header):
+    """Whether a request's X-Profile header switches sampling on."""
+    return bool(profile_token) and header == profile_token
+
+
+def path_for(name):
+    return os.path.join(profile_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{name}.collapsed')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import threading
+import time
+
+import db
+import upstream
+
+profile_ttl     = float(os.getenv("PROFILE_TTL", str(30 * 24 * 3600)))
+profile_workers = int(os.getenv("PROFILE_WORKERS", "5"))
+
+
+class ProfileStore:
+    """Operator descriptions persisted in the ``operator_profiles`` table.
+
+    Stored profiles are always served as they are; once older than ``ttl``
+    they are regenerated in the background so the request never waits on
+    the AI service.  Profiles that are missing are generated concurrently.
+    ``generate`` is a coroutine function run on the shared upstream loop.
+    """
+
+    def __init__(self, pool, generate, ttl=profile_ttl, workers=profile_workers):
+        self.pool = pool
+        self.generate = generate
+        self.ttl = ttl
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._semaphore = None
+        self._refreshing = set()
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_errors': 0}
+
+    def _check_fork(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._semaphore = None
+                self._refreshing = set()
+
+    def get_many(self, names, admit=None):
+        """Profiles of ``names``; ``admit`` is called before any is generated
+        while the request waits, and may raise to refuse it."""
+        self._check_fork()
+        with self.pool.connection() as con:
+            rows = con.execute(db.PROFILE_SELECT.format(db.placeholders(len(names))), names).fetchall()
+        stored = {name: (info, updated) for name, info, updated in rows}
+
+        now = time.time()
+        missing = [name for name in names if name not in stored]
+        stale = [name for name in names if name in stored and now - stored[name][1] > self.ttl]
+        with self._lock:
+            self._stats['hits'] += len(names) - len(missing)
+            self._stats['misses'] += len(missing)
+
+        for name in stale:
+            self._refresh(name)
+
+        profiles = {name: info for name, (info, updated) in stored.items()}
+        if missing:
+            if admit is not None:
+                admit()
+            results = upstream.run(self._generate_all(missing))
+            generated = {name: info for name, info in zip(missing, results) if not isinstance(info, BaseException)}
+            if generated:
+                self._store([(name, info, now) for name, info in generated.items()])
+            for info in results:
+                if isinstance(info, BaseException):
+                    raise info
+            profiles.update(generated)
+        return profiles
+
+    def _store(self, rows):
+        with self.pool.transaction() as con:
+            con.executemany(db.PROFILE_UPSERT, rows)
+
+    async def _generate(self, name):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        async with self._semaphore:
+            return await self.generate(name)
+
+    async def _generate_all(self, names):
+        return await asyncio.gather(*[self._generate(name) for name in names], return_exceptions=True)
+
+    def _refresh(self, name):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+        upstream.submit(self._refresh_one(name))
+
+    async def _refresh_one(self, name):
+        try:
+            info = await self._generate(name)
+            await asyncio.to_thread(self._store, [(name, info, time.time())])
+            with self._lock:
+                self._stats['refreshes'] += 1
+        except Exception:
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['refreshing'] = len(self._refreshing)
+            stats['ttl'] = self.ttl
+        return stats
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import difflib
+import os
+import re
+import unicodedata
+
+import db
+
+fuzzy_ratio = float(os.getenv("SEARCH_FUZZY_RATIO", "0.8"))
+CANDIDATES = 50
+
+
+def words(text):
+    """Lower-cased words of ``text`` with the diacritics stripped."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return re.findall(r'\w+', ''.join(c for c in text if not unicodedata.combining(c)))
+
+
+def similarity(terms, name_words):
+    """Mean over the query words of their best match ratio with a name word."""
+    if not name_words:
+        return 0.0
+    return sum(max(difflib.SequenceMatcher(None, term, word).ratio() for word in name_words)
+               for term in terms) / len(terms)
+
+
+def names(query, name):
+    """Whether ``query`` is the stop name ``name``, up to case, accents and
+    punctuation, with the place in brackets optional: 'S+U Alexanderplatz
+    Bhf' names 'S+U Alexanderplatz Bhf (Berlin)', 'Alexanderplatz' does not.
+    """
+    terms = words(query)
+    return bool(terms) and terms in (words(name), words(re.sub(r'\([^)]*\)', ' ', name)))
+
+
+def trigram_match(term):
+    """An FTS5 query for names holding either end of ``term`` intact.
+
+    One typo breaks at most four neighbouring trigrams, so for most words
+    the first or the last third of them survives; requiring all of a third
+    keeps the candidate set small.
+    """
+    grams = [f'"{term[i:i + 3]}"' for i in range(len(term) - 2)]
+    k = max(1, len(grams) // 3)
+    return f"(({' AND '.join(grams[:k])}) OR ({' AND '.join(grams[-k:])}))"
+
+
+def stops(con, query, limit=5, fuzzy=True):
+    """Stored stops whose name matches ``query``, best first, as (stop_id, name).
+
+    Every word of the query has to start a word of the name, so 'alex bhf'
+    finds 'S+U Alexanderplatz Bhf (Berlin)'.  Only if nothing matches that
+    way, and ``fuzzy`` is set, are names sharing trigrams with each query
+    word scored for similarity, which lets small typos ('Alexandreplatz')
+    through.
+    """
+    terms = words(query)
+    if not terms:
+        return []
+    rows = con.execute(db.STOP_SEARCH, (' '.join(f'"{term}"*' for term in terms), limit)).fetchall()
+    if rows or not fuzzy:
+        return rows
+
+    long_terms = [term for term in terms if len(term) >= 3]
+    if not long_terms:
+        return []
+    match = ' AND '.join(trigram_match(term) for term in long_terms)
+    candidates = con.execute(db.STOP_SEARCH_TRIGRAM, (match, CANDIDATES))
+    scored = [(similarity(terms, words(name)), stop_id, name) for stop_id, name in candidates if name]
+    scored.sort(key=lambda hit: -hit[0])
+    return [(stop_id, name) for score, stop_id, name in scored if score >= fuzzy_ratio][:limit]
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+import admission
+
+
+def test_request_beyond_slots_and_queue_is_shed():
+    lane = admission.Lane('test', 1, 0, 0, 1)
+    release = lane.admit('a')
+    with pytest.raises(admission.Rejected) as e:
+        lane.admit('b')
+    assert e.value.status == 503
+    assert e.value.retry_after >= 1
+    release()
+    lane.admit('b')()
+    assert lane.metrics()['queue_full'] == 1
+
+
+def test_queued_request_gets_the_slot_given_back():
+    lane = admission.Lane('test', 1, 1, 0, 1, timeout=5)
+    release = lane.admit('a')
+    admitted = []
+    t = threading.Thread(target=lambda: admitted.append(lane.admit('b')))
+    t.start()
+    while lane.metrics()['waiting'] < 1:
+        threading.Event().wait(0.01)
+    release()
+    t.join(5)
+    assert len(admitted) == 1
+    assert lane.metrics()['in_flight'] == 1
+
+
+def test_queue_timeout_is_shed():
+    lane = admission.Lane('test', 1, 1, 0, 1, timeout=0.05)
+    lane.admit('a')
+    with pytest.raises(admission.Rejected) as e:
+        lane.admit('b')
+    assert e.value.status == 503
+    assert lane.metrics()['queue_timeout'] == 1
+
+
+def test_client_beyond_its_rate_gets_429():
+    lane = admission.Lane('test', 0, 0, 1 / 60, 2)
+    lane.admit('a')()
+    lane.admit('a')()
+    with pytest.raises(admission.Rejected) as e:
+        lane.admit('a')
+    assert e.value.status == 429
+    assert e.value.retry_after > 1
+    lane.admit('b')()
+
+
+def test_shed_request_does_not_spend_a_token():
+    lane = admission.Lane('test', 1, 0, 1 / 60, 1)
+    release = lane.admit('a')
+    with pytest.raises(admission.Rejected) as e:
+        lane.admit('b')
+    assert e.value.status == 503
+    release()
+    lane.admit('b')()
+    assert lane.metrics()['rate_limited'] == 0
+
+
+def test_release_is_idempotent():
+    lane = admission.Lane('test', 1, 0, 0, 1)
+    release = lane.admit('a')
+    release()
+    release()
+    assert lane.metrics()['in_flight'] == 0
@@ -0,0 +1,130 @@
+import datetime
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench'))
+import gemini_standin
+
+NOW_FORMAT = "%Y-%m-%d-%H:%M:%S"
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    gemini = gemini_standin.serve()
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('GOOGLE_API_KEY', 'test')
+        mp.setenv('GEMINI_BASE_URL', f'http://127.0.0.1:{gemini.server_port}')
+        mp.setenv('PREFETCH', '0')
+        mp.setenv('ADMISSION', '0')
+        mp.setenv('WRITE_BEHIND_INTERVAL', '0')
+        module = importlib.import_module('app')
+        module.gemini_standin = gemini
+        yield module
+    os.chdir(cwd)
+    gemini.shutdown()
+
+
+@pytest.fixture
+def client(app):
+    with app.pool.transaction() as con:
+        con.execute("DELETE FROM stops")
+        con.execute("DELETE FROM guides")
+    return app.app.test_client()
+
+
+def add_stop(app, stop_id, name, depa='Platform 1 towards S Westkreuz'):
+    now = datetime.datetime.now().strftime(NOW_FORMAT)
+    with app.pool.transaction() as con:
+        con.execute("INSERT INTO stops (stop_id, name, latitude, longitude, time, link, depa, depa_time) \
+                     VALUES (?, ?, 52.5, 13.4, ?, ?, ?, ?)",
+                    (stop_id, name, now, f'http://127.0.0.1:5000/stops/{stop_id}', depa, now))
+
+
+def get(client, path, **kwargs):
+    response = client.get(path, **kwargs)
+    try:
+        return response.status_code, response.headers, response.get_data(as_text=True)
+    finally:
+        response.close()
+
+
+def test_unchanged_stop_is_answered_304(app, client):
+    add_stop(app, 900100001, 'Alexanderplatz')
+    status, headers, body = get(client, '/stops/900100001')
+    assert status == 200
+    etag = headers['ETag']
+
+    status, headers, body = get(client, '/stops/900100001', headers={'If-None-Match': etag})
+    assert status == 304
+    assert body == ''
+    assert headers['ETag'] == etag
+
+
+def test_changed_stop_or_query_gets_a_new_etag(app, client):
+    add_stop(app, 900100001, 'Alexanderplatz')
+    _, headers, _ = get(client, '/stops/900100001')
+    etag = headers['ETag']
+
+    status, headers, _ = get(client, '/stops/900100001?include=name', headers={'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] != etag
+
+    with app.pool.transaction() as con:
+        con.execute("UPDATE stops SET name = 'S+U Alexanderplatz' WHERE stop_id = 900100001")
+    status, headers, _ = get(client, '/stops/900100001', headers={'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] != etag
+
+
+def guide(app, client, answer):
+    app.gemini_standin.RequestHandlerClass.canned = [['', answer]]
+    add_stop(app, 900100001, 'Alexanderplatz')
+    add_stop(app, 900100002, 'Hackescher Markt')
+    return get(client, '/guide')
+
+
+def stored_guides(app):
+    with app.pool.connection() as con:
+        return con.execute("SELECT COUNT(*) FROM guides").fetchone()[0]
+
+
+def test_guide_is_streamed_and_then_served_from_the_store(app, client):
+    status, headers, body = guide(app, client, 'A walk from Alexanderplatz to Hackescher Markt. ' * 5)
+    assert status == 200
+    assert headers['X-Guide-Cache'] == 'MISS'
+    assert body.startswith('A walk')
+    assert stored_guides(app) == 1
+
+    status, headers, cached = get(client, '/guide')
+    assert (status, headers['X-Guide-Cache'], cached) == (200, 'HIT', body)
+
+
+def test_guide_refused_at_once_is_400(app, client):
+    status, _, body = guide(app, client, 'NOTFOUND')
+    assert status == 400
+    assert 'cannot provide a guide' in body
+    assert stored_guides(app) == 0
+
+
+def test_guide_refused_after_its_opening_is_not_stored(app, client):
+    refused = app.guide_stats['refused']
+    status, _, body = guide(app, client, 'Let me check the lines between these stops. ' * 3 + 'NOTFOUND')
+    assert status == 200
+    assert body.endswith('NOTFOUND')
+    assert stored_guides(app) == 0
+    assert app.guide_stats['refused'] == refused + 1
+
+
+def test_patch_with_a_body_that_is_not_an_object_is_400(app, client):
+    add_stop(app, 900100001, 'Alexanderplatz')
+    response = client.patch('/stops/900100001', json=['name'])
+    try:
+        assert response.status_code == 400
+        assert response.get_json()['message'] == 'You did not input anything valid to update.'
+    finally:
+        response.close()
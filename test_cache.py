@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+import cache
+
+
+def slow_loader(calls, release, value):
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return value
+    return loader
+
+
+def test_concurrent_misses_share_one_load():
+    c = cache.TTLCache(30, 10)
+    calls, release, results = [], threading.Event(), []
+    threads = [threading.Thread(target=lambda: results.append(c.get('k', slow_loader(calls, release, 'v'))))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    while c.metrics()['coalesced'] < 7:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+    assert calls == [1]
+    assert results == ['v'] * 8
+    assert c.get('k', lambda: 'other') == 'v'
+
+
+def test_failed_load_reaches_every_waiter_and_is_not_kept():
+    c = cache.TTLCache(30, 10)
+    started, release, errors = threading.Event(), threading.Event(), []
+
+    def loader():
+        started.set()
+        release.wait(5)
+        raise ValueError('down')
+
+    def call():
+        try:
+            c.get('k', loader)
+        except ValueError as e:
+            errors.append(e)
+
+    first = threading.Thread(target=call)
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=call)
+    second.start()
+    while c.metrics()['coalesced'] < 1:
+        time.sleep(0.01)
+    release.set()
+    first.join()
+    second.join()
+    assert len(errors) == 2
+    assert c.get('k', lambda: 'v') == 'v'
+
+
+def test_value_refused_by_should_cache_is_loaded_again():
+    c = cache.TTLCache(30, 10, should_cache=lambda value: value is not None)
+    assert c.get('k', lambda: None) is None
+    assert c.get('k', lambda: 'v') == 'v'
+    assert c.peek('k') == 'v'
+
+
+def test_get_many_loads_only_missing_keys_once():
+    c = cache.TTLCache(30, 10)
+    c.set('a', 1)
+    asked = []
+
+    def loader(keys):
+        asked.append(list(keys))
+        return [k * 2 for k in keys]
+
+    assert c.get_many(['a', 'b', 'b', 'c'], loader) == {'a': 1, 'b': 'bb', 'c': 'cc'}
+    assert asked == [['b', 'c']]
+
+
+def test_get_many_waits_for_a_key_in_flight():
+    c = cache.TTLCache(30, 10)
+    calls, release = [], threading.Event()
+    t = threading.Thread(target=c.get, args=('a', slow_loader(calls, release, 'from get')))
+    t.start()
+    while not calls:
+        time.sleep(0.01)
+    threading.Timer(0.05, release.set).start()
+    assert c.get_many(['a', 'b'], lambda keys: ['from many'] * len(keys)) == {'a': 'from get', 'b': 'from many'}
+    t.join()
+
+
+def test_expired_entry_is_only_peeked_when_stale_allowed(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    c = cache.TTLCache(30, 10)
+    c.set('k', 'old')
+    now[0] += 31
+    assert c.peek('k') is None
+    assert c.peek('k', stale=True) == 'old'
+    assert c.metrics()['stale'] == 1
+    assert c.get('k', lambda: 'new') == 'new'
+
+
+def test_least_recently_used_entry_is_evicted():
+    c = cache.TTLCache(30, 2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a', pytest.fail)
+    c.set('c', 3)
+    assert c.peek('b', stale=True) is None
+    assert c.peek('a') == 1
+    assert c.metrics()['evictions'] == 1
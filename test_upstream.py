@@ -0,0 +1,71 @@
+import asyncio
+
+import upstream
+
+
+class Reply:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def attempts(*plan):
+    """A call whose n-th attempt answers plan[n] = (seconds, status) and
+    records whether it ran to its end or was cancelled."""
+    outcome = []
+
+    async def call():
+        delay, status = plan[len(outcome)]
+        outcome.append('started')
+        i = len(outcome) - 1
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            outcome[i] = 'cancelled'
+            raise
+        outcome[i] = 'done'
+        return Reply(status)
+
+    return call, outcome
+
+
+def test_fast_answer_is_not_hedged():
+    call, outcome = attempts((0, 200))
+    assert asyncio.run(upstream.hedged(call, 0.1)).status_code == 200
+    assert outcome == ['done']
+
+
+def test_hedge_wins_and_slow_attempt_is_cancelled_and_awaited():
+    call, outcome = attempts((1, 200), (0, 201))
+
+    async def main():
+        reply = await upstream.hedged(call, 0.01)
+        return reply.status_code, list(outcome)
+
+    assert asyncio.run(main()) == (201, ['cancelled', 'done'])
+
+
+def test_server_error_waits_for_the_other_attempt():
+    call, outcome = attempts((0.05, 200), (0, 503))
+    assert asyncio.run(upstream.hedged(call, 0.01)).status_code == 200
+    assert outcome == ['done', 'done']
+
+
+def cancelled(call, outcome, delay, timeout):
+    """The attempts' outcome as soon as the caller got its timeout."""
+    async def main():
+        try:
+            await asyncio.wait_for(upstream.hedged(call, delay), timeout)
+        except asyncio.TimeoutError:
+            return list(outcome)
+
+    return asyncio.run(main())
+
+
+def test_caller_cancelled_before_the_hedge_cancels_the_attempt():
+    call, outcome = attempts((1, 200))
+    assert cancelled(call, outcome, 0.5, 0.01) == ['cancelled']
+
+
+def test_caller_cancelled_after_the_hedge_cancels_both_attempts():
+    call, outcome = attempts((1, 200), (1, 200))
+    assert cancelled(call, outcome, 0.01, 0.05) == ['cancelled', 'cancelled']
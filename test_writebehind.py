@@ -0,0 +1,57 @@
+import pytest
+
+import db
+import writebehind
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = db.Pool(str(tmp_path / 'test.db'), size=2)
+    with pool.transaction() as con:
+        con.execute("INSERT INTO stops (stop_id, name, time) VALUES (1, 'A', 't0'), (2, 'B', 't0')")
+    return pool
+
+
+def stored(pool, stop_id):
+    with pool.connection() as con:
+        return con.execute("SELECT depa, time, depa_time FROM stops WHERE stop_id = ?", (stop_id,)).fetchone()
+
+
+def test_refresh_is_visible_before_and_written_at_flush(pool):
+    writes = writebehind.WriteBehind(pool, interval=3600)
+    writes.put(1, 'Platform 1 towards X', 't1', 't0')
+    assert writes.get(1) == ('Platform 1 towards X', 't1')
+    assert stored(pool, 1) == (None, 't0', None)
+    assert writes.flush() == 1
+    assert stored(pool, 1) == ('Platform 1 towards X', 't1', 't1')
+    assert writes.get(1) is None
+
+
+def test_refresh_does_not_overwrite_a_later_write(pool):
+    writes = writebehind.WriteBehind(pool, interval=3600)
+    writes.put(1, 'stale', 't1', 't0')
+    with pool.transaction() as con:
+        con.execute("UPDATE stops SET depa = 'patched', time = 't2' WHERE stop_id = 1")
+    assert writes.flush() == 0
+    assert stored(pool, 1) == ('patched', 't2', None)
+    assert writes.metrics()['conflicts'] == 1
+
+
+def test_refresh_does_not_bring_back_a_deleted_stop(pool):
+    writes = writebehind.WriteBehind(pool, interval=3600)
+    writes.put(1, 'gone', 't1', 't0')
+    writes.put_lines(1, [('S5', 1, 'S Westkreuz', 100.0)], 0)
+    with pool.transaction() as con:
+        con.execute("DELETE FROM stops WHERE stop_id = 1")
+    assert writes.flush() == 0
+    assert stored(pool, 1) is None
+    with pool.connection() as con:
+        assert con.execute("SELECT COUNT(*) FROM stop_lines").fetchone()[0] == 0
+
+
+def test_coalesced_refresh_keeps_the_first_base(pool):
+    writes = writebehind.WriteBehind(pool, interval=3600)
+    writes.put(2, 'first', 't1', 't0')
+    writes.put(2, 'second', 't2', 't1')
+    assert writes.flush() == 1
+    assert stored(pool, 2) == ('second', 't2', 't2')
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import collections
+import datetime
+import sys
+
+import codec
+
+# One departure of a VBB board, keeping only the fields the API reads.
+# ``when`` is the time as VBB sent it, ``at`` the same instant in epoch
+# seconds, and ``delay`` is in seconds.
+Departure = collections.namedtuple('Departure', 'when at platform direction line operator delay')
+
+
+def departures(depas):
+    # Inlined: this runs for every departure of every board fetched.
+    intern = sys.intern
+    fromisoformat = datetime.datetime.fromisoformat
+    out = []
+    for depa in depas:
+        when = depa.get('when') or depa.get('plannedWhen')
+        try:
+            at = fromisoformat(when).timestamp() if when else None
+        except ValueError:
+            at = None
+        line = depa.get('line') or {}
+        operator = line.get('operator') or {}
+        platform = depa.get('platform')
+        direction = depa.get('direction')
+        name = line.get('name')
+        op = operator.get('name')
+        # Directions, lines and operators repeat across every cached board.
+        out.append(Departure(when, at, intern(platform) if platform.__class__ is str else platform,
+                             intern(direction) if direction.__class__ is str else direction,
+                             intern(name) if name.__class__ is str else name,
+                             intern(op) if op.__class__ is str else op, depa.get('delay')))
+    return tuple(out)
+
+
+def decode(content):
+    """The departures in the body of a VBB departures response, as a tuple.
+
+    The payload is parsed once and dropped; what is kept is a small fraction
+    of it, so boards can be cached for many stops.  Raises ValueError if the
+    body is not a departures payload.
+    """
+    payload = codec.loads(content)
+    try:
+        depas = payload['departures'] if isinstance(payload, dict) else payload
+        return departures(depas)
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError('not a departures payload') from e
+
+
+def as_dict(depa):
+    return {'when': depa.when, 'platform': depa.platform, 'direction': depa.direction,
+            'line': depa.line, 'operator': depa.operator, 'delay': depa.delay}
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import asyncio
+import importlib.util
+import os
+import queue
+import threading
+import time
+
+import httpx
+
+import metrics
+
+vbb_url          = os.getenv("VBB_BASE_URL", "https://v6.vbb.transport.rest").rstrip('/')
+max_connections  = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+max_keepalive    = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+keepalive_expiry = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+timeout          = float(os.getenv("UPSTREAM_TIMEOUT", "10"))
+timeouts         = {
+    'locations':  float(os.getenv("UPSTREAM_TIMEOUT_LOCATIONS", str(timeout))),
+    'departures': float(os.getenv("UPSTREAM_TIMEOUT_DEPARTURES", str(timeout))),
+    'stop':       float(os.getenv("UPSTREAM_TIMEOUT_STOP", str(timeout))),
+}
+hedge_after      = float(os.getenv("UPSTREAM_HEDGE_MS", "0")) / 1000
+breaker_failures = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+breaker_reset    = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+http2            = importlib.util.find_spec('h2') is not None
+
+metrics.registry.describe('upstream_requests_total', 'counter', 'Upstream calls by service and status code')
+metrics.registry.describe('upstream_request_duration_seconds', 'histogram', 'Upstream call latency')
+metrics.registry.describe('upstream_in_flight', 'gauge', 'Upstream calls waiting for an answer')
+metrics.registry.describe('upstream_hedges_total', 'counter', 'Second attempts sent for slow upstream GETs')
+
+
+class Unavailable(Exception):
+    """VBB did not answer: the call timed out, failed, or the breaker is open."""
+
+
+class Breaker:
+    """Fails calls fast after ``failures`` consecutive upstream failures.
+
+    While open every call is rejected for ``reset`` seconds; then a single
+    trial call is let through, and its outcome closes or reopens it.
+    """
+
+    def __init__(self, failures=breaker_failures, reset=breaker_reset):
+        self.failures = failures
+        self.reset = reset
+        self._lock = threading.Lock()
+        self._count = 0
+        self._opened = None
+        self._trial = False
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or time.monotonic() - self._opened < self.reset:
+                self._stats['rejected'] += 1
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self._trial or (self._opened is None and self._count >= self.failures):
+                self._stats['opened'] += 1
+                self._opened = time.monotonic()
+            self._trial = False
+
+    def abandon(self):
+        """Forget a call that ended without an answer either way."""
+        with self._lock:
+            self._trial = False
+
+    def state(self):
+        with self._lock:
+            if self._opened is None:
+                return 'closed'
+            return 'half-open' if self._trial or time.monotonic() - self._opened >= self.reset else 'open'
+
+    def metrics(self):
+        state = self.state()
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open'] = state != 'closed'
+            stats['consecutive_failures'] = self._count
+        return stats
+
+
+breaker = Breaker()
+
+_lock = threading.Lock()
+_pid = None
+_loop = None
+_client = None
+
+
+def loop():
+    """The process-wide event loop that all upstream I/O runs on.
+
+    It lives in a daemon thread and is started on first use, so a forked
+    worker gets its own loop (and its own connections) instead of sharing
+    the parent's.
+    """
+    global _pid, _loop, _client
+    with _lock:
+        if _pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _client = None
+            threading.Thread(target=_loop.run_forever, name='upstream', daemon=True).start()
+            _pid = os.getpid()
+        return _loop
+
+
+def attach(running):
+    """Run upstream I/O on an event loop the server already drives.
+
+    Under an ASGI server this puts the HTTP client on the server's own loop
+    rather than on a second loop thread competing with it.
+    """
+    global _pid, _loop, _client
+    with _lock:
+        if _loop is not running or _pid != os.getpid():
+            _loop = running
+            _client = None
+            _pid = os.getpid()
+
+
+def client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_keepalive,
+                                keepalive_expiry=keepalive_expiry),
+            timeout=None,
+        )
+    return _client
+
+
+def run(coro):
+    """Run ``coro`` on the upstream loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, loop()).result()
+
+
+def submit(coro):
+    """Schedule ``coro`` on the upstream loop without waiting for it."""
+    return asyncio.run_coroutine_threadsafe(coro, loop())
+
+
+async def timed(service, awaitable):
+    """Await an upstream call, counting it by status code and timing it."""
+    labels = {'service': service}
+    status = 'error'
+    metrics.registry.add('upstream_in_flight', labels, 1)
+    start = time.perf_counter()
+    try:
+        result = await awaitable
+        status = getattr(result, 'status_code', 'ok')
+        return result
+    except asyncio.TimeoutError:
+        status = 'timeout'
+        raise
+    except Exception as e:
+        status = getattr(e, 'code', None) or 'error'
+        raise
+    finally:
+        metrics.registry.add('upstream_in_flight', labels, -1)
+        metrics.registry.observe('upstream_request_duration_seconds', labels, time.perf_counter() - start)
+        metrics.registry.inc('upstream_requests_total', {'service': service, 'status': status})
+
+
+def endpoint(path):
+    if path.startswith('/locations'):
+        return 'locations'
+    return 'departures' if path.endswith('/departures') else 'stop'
+
+
+async def hedged(call, delay):
+    """Await ``call()``, starting a second attempt if the first is slow.
+
+    Whichever attempt answers first without a 5xx wins and the other is
+    cancelled.  Only for idempotent requests.
+    """
+    first = asyncio.ensure_future(call())
+    if not delay:
+        return await first
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        metrics.registry.inc('upstream_hedges_total', {'service': 'vbb'})
+        tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code < 500:
+                    return task.result()
+        return task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # The losers are awaited too, so an error of theirs is retrieved
+        # instead of logged as never retrieved.
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def vbb_get(path, params=None):
+    """GET from VBB within the endpoint's timeout, behind the circuit breaker.
+
+    Raises Unavailable instead of waiting on a VBB that is down or slow.
+    """
+    if not breaker.allow():
+        raise Unavailable('VBB circuit breaker is open')
+    settled = False
+    try:
+        call = lambda: client().get(vbb_url + path, params=params)
+        r = await timed('vbb', asyncio.wait_for(hedged(call, hedge_after), timeouts[endpoint(path)]))
+        settled = True
+        if r.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return r
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        settled = True
+        breaker.failure()
+        raise Unavailable(f'VBB {endpoint(path)} request failed: {e!r}') from e
+    finally:
+        if not settled:
+            breaker.abandon()
+
+
+async def generate(ai, prompt):
+    return await timed('gemini', ai.aio.models.generate_content(model="gemini-2.0-flash", contents=prompt))
+
+
+async def generate_stream(ai, prompt):
+    return await timed('gemini', ai.aio.models.generate_content_stream(model="gemini-2.0-flash", contents=prompt))
+
+
+def iterate(aiter):
+    """Consume an async iterator on the upstream loop from a blocking caller.
+
+    ``aiter`` is an awaitable resolving to the async iterator.  Items are
+    handed over through a queue as they arrive; closing the generator early
+    cancels the upstream task.
+    """
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in await aiter:
+                items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+        finally:
+            items.put((done, None))
+
+    future = submit(pump())
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        future.cancel()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+import codec
+import db
+
+write_behind_interval = float(os.getenv("WRITE_BEHIND_INTERVAL", "1"))
+write_behind_max      = int(os.getenv("WRITE_BEHIND_MAX", "500"))
+
+
+class WriteBehind:
+    """Departure refreshes waiting to be written to the stops table.
+
+    ``put`` replaces whatever is pending for the stop, and ``get`` returns
+    it, so a refresh is visible to reads at once.  A thread writes all
+    pending refreshes in one transaction every ``interval`` seconds, or as
+    soon as ``maxsize`` stops are pending, and once more at exit.  With an
+    interval of 0 every ``put`` is written straight away.
+
+    A refresh is only written if the row's time is still the one it was
+    based on, so it never overwrites a later write to the stop, nor brings
+    back a deleted one.
+
+    ``put_lines`` queues the lines seen on a stop's board the same way;
+    they are written in the same transaction.
+    """
+
+    def __init__(self, pool, interval=write_behind_interval, maxsize=write_behind_max):
+        self.pool = pool
+        self.interval = interval
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}
+        self._flushing = {}
+        self._lines = {}
+        self._pid = None
+        self._stats = {'puts': 0, 'coalesced': 0, 'flushes': 0, 'written': 0, 'conflicts': 0, 'errors': 0,
+                       'lines_written': 0, 'max_batch': 0, 'last_flush_ms': None}
+        atexit.register(self.flush)
+
+    def put(self, stop_id, depa, dtime, base):
+        """Queue ``depa``/``dtime`` for the stop, read from the database with time ``base``."""
+        with self._lock:
+            self._stats['puts'] += 1
+            queued = self._pending.get(stop_id) or self._flushing.get(stop_id)
+            if queued is not None:
+                base = queued[2] if stop_id in self._pending else queued[1]
+                self._stats['coalesced'] += 1
+            self._pending[stop_id] = (depa, dtime, base)
+            full = len(self._pending) + len(self._lines) >= self.maxsize
+        self._queued(full)
+
+    def put_lines(self, stop_id, rows, expire_before):
+        """Queue the stop_lines ``rows`` of the stop, and dropping its lines
+        not seen since ``expire_before``."""
+        with self._lock:
+            self._merge_lines(stop_id, {(row[0], row[2]): row for row in rows}, expire_before)
+            full = len(self._pending) + len(self._lines) >= self.maxsize
+        self._queued(full)
+
+    def _merge_lines(self, stop_id, rows, expire_before):
+        queued = self._lines.get(stop_id)
+        if queued is not None:
+            rows = {**queued[0], **rows}
+            expire_before = min(expire_before, queued[1])
+        self._lines[stop_id] = (rows, expire_before)
+
+    def _queued(self, full):
+        if self.interval <= 0:
+            self.flush()
+            return
+        self._start()
+        if full:
+            self._wake.set()
+
+    def get(self, stop_id):
+        """The pending (depa, time) of the stop, or None."""
+        with self._lock:
+            queued = self._pending.get(stop_id) or self._flushing.get(stop_id)
+        return queued[:2] if queued is not None else None
+
+    def snapshot(self):
+        """Every pending stop_id -> (depa, time)."""
+        with self._lock:
+            if not self._pending and not self._flushing:
+                return {}
+            queued = {**self._flushing, **self._pending}
+        return {stop_id: entry[:2] for stop_id, entry in queued.items()}
+
+    def flush(self):
+        """Write everything pending now; returns the rows written."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending and not self._lines:
+                    return 0
+                self._flushing, self._pending = self._pending, {}
+                lines, self._lines = self._lines, {}
+            batch = self._flushing
+            line_rows = [row for rows, _ in lines.values() for row in rows.values()]
+            start = time.perf_counter()
+            try:
+                with self.pool.transaction() as con:
+                    written = 0
+                    if batch:
+                        rows = codec.dumps([(stop_id, depa, dtime, base)
+                                            for stop_id, (depa, dtime, base) in batch.items()]).decode()
+                        written = con.execute(db.STOP_SET_DEPA_MANY, (rows,)).rowcount
+                    if lines:
+                        con.execute(db.LINES_UPSERT_MANY, (codec.dumps(line_rows).decode(),))
+                        con.execute(db.LINES_EXPIRE_MANY, (min(expire for _, expire in lines.values()),
+                                                           codec.dumps(list(lines)).decode()))
+            except (sqlite3.Error, db.PoolTimeout):
+                # Kept for the next flush; a newer refresh of the same stop
+                # takes its place but is still based on what is stored.
+                with self._lock:
+                    for stop_id, entry in batch.items():
+                        newer = self._pending.get(stop_id)
+                        self._pending[stop_id] = entry if newer is None else newer[:2] + entry[2:]
+                    for stop_id, (rows, expire_before) in lines.items():
+                        newer = self._lines.pop(stop_id, None)
+                        self._lines[stop_id] = (rows, expire_before)
+                        if newer is not None:
+                            self._merge_lines(stop_id, *newer)
+                    self._flushing = {}
+                    self._stats['errors'] += 1
+                return 0
+            with self._lock:
+                self._flushing = {}
+                self._stats['flushes'] += 1
+                self._stats['written'] += written
+                self._stats['lines_written'] += len(line_rows)
+                self._stats['conflicts'] += len(batch) - written
+                self._stats['max_batch'] = max(self._stats['max_batch'], len(batch))
+                self._stats['last_flush_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            return written
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='write-behind', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+            stats['pending_lines'] = len(self._lines)
+        stats['interval'] = self.interval
+        stats['maxsize'] = self.maxsize
+        return stats